@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for exportiphoto.
+
+  python benchmark.py generate [options] <library dir>
+      Write a synthetic iPhoto library (AlbumData.xml and image files).
+
+  python benchmark.py run [options] [<library dir>]
+      Time parsing, walking and copying a library (a synthetic one is
+      generated if none is given) and print the results; with -o, also
+      save them as JSON.
+
+  python benchmark.py compare <old.json> <new.json>
+      Compare two saved runs, e.g. from before and after a change.
+
+Each case runs in its own process so that its peak RSS can be measured.
+"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+apple_epoch = 978307200
+
+default_cases = ["parse", "plan", "walk", "copy", "recopy"]
+
+
+def generate_library(library_dir, images=1000, events=None, albums=None,
+                     album_overlap=1.5, faces=50, keywords=100,
+                     image_size=4096, write_files=True, name_repeat=10000,
+                     seed=1):
+    """
+    Write a synthetic iPhoto library to library_dir with the given number
+    of images, spread evenly over events. Each image is in album_overlap
+    albums on average, and has up to three keywords and two faces. File
+    names repeat every name_repeat images, as camera names do; use 1 (and
+    a single event) for the worst case for deconflicting.
+    """
+    rnd = random.Random(seed)
+    events = events or max(1, images // 50)
+    albums = albums or max(1, images // 200)
+    masters = os.path.join(library_dir, "Masters")
+    if not os.path.exists(masters):
+        os.makedirs(masters)
+    data = bytes(bytearray([rnd.randrange(256) for i in range(image_size)]))
+
+    event_images = [[] for e in range(events)]
+    album_images = [[] for a in range(albums)]
+    for image in range(images):
+        event_images[image * events // images].append(image)
+        count = int(album_overlap) + (rnd.random() < album_overlap % 1)
+        for album in rnd.sample(range(albums), min(count, albums)):
+            album_images[album].append(image)
+
+    start_date = 250000000 # 2008-12-03, in seconds since the Apple epoch
+    event_dates = [start_date + e * 86400 for e in range(events)]
+
+    out = open(os.path.join(library_dir, "AlbumData.xml"), "w")
+    w = out.write
+    w('<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<plist version="1.0">\n<dict>\n'
+      '\t<key>Application Version</key>\n\t<string>8.1.2</string>\n'
+      '\t<key>Archive Path</key>\n\t<string>%s</string>\n'
+      % escape(library_dir))
+
+    def write_folder(type_key, name_key, folder_id, name, keys, extra):
+        w('\t\t<dict>\n\t\t\t<key>%s</key>\n\t\t\t<integer>%d</integer>\n'
+          '\t\t\t<key>%s</key>\n\t\t\t<string>%s</string>\n%s'
+          '\t\t\t<key>KeyList</key>\n\t\t\t<array>\n'
+          % (type_key, folder_id, name_key, escape(name), extra))
+        for key in keys:
+            w('\t\t\t\t<string>%d</string>\n' % key)
+        w('\t\t\t</array>\n\t\t</dict>\n')
+
+    w('\t<key>List of Albums</key>\n\t<array>\n')
+    for album, keys in enumerate(album_images):
+        write_folder("AlbumId", "AlbumName", album, "Album %d" % album, keys,
+                     '\t\t\t<key>Album Type</key>\n'
+                     '\t\t\t<string>Regular</string>\n')
+    w('\t</array>\n')
+
+    w('\t<key>List of Faces</key>\n\t<dict>\n')
+    for face in range(faces):
+        w('\t\t<key>%d</key>\n\t\t<dict>\n'
+          '\t\t\t<key>key</key>\n\t\t\t<integer>%d</integer>\n'
+          '\t\t\t<key>name</key>\n\t\t\t<string>Person %d</string>\n'
+          '\t\t</dict>\n' % (face, face, face))
+    w('\t</dict>\n')
+
+    w('\t<key>List of Keywords</key>\n\t<dict>\n')
+    for keyword in range(keywords):
+        w('\t\t<key>%d</key>\n\t\t<string>Keyword %d</string>\n'
+          % (keyword, keyword))
+    w('\t</dict>\n')
+
+    w('\t<key>List of Rolls</key>\n\t<array>\n')
+    for event, keys in enumerate(event_images):
+        if event % 3:
+            name = time.strftime(
+                "%b %d, %Y",
+                time.gmtime(apple_epoch + event_dates[event])
+            ).replace(" 0", " ")
+        else:
+            name = "Event %d" % event
+        write_folder("RollID", "RollName", event, name, keys,
+                     '\t\t\t<key>RollDateAsTimerInterval</key>\n'
+                     '\t\t\t<real>%d.000000</real>\n' % event_dates[event])
+    w('\t</array>\n'
+      '\t<key>Major Version</key>\n\t<integer>2</integer>\n'
+      '\t<key>Minor Version</key>\n\t<integer>0</integer>\n')
+
+    w('\t<key>Master Image List</key>\n\t<dict>\n')
+    for event, keys in enumerate(event_images):
+        day = time.gmtime(apple_epoch + event_dates[event])
+        folder = os.path.join(masters, time.strftime("%Y/%m/%d", day),
+                              "Event%d" % event)
+        if write_files and not os.path.exists(folder):
+            os.makedirs(folder)
+        for image in keys:
+            path = os.path.join(folder, "IMG_%04d.JPG" % (image % name_repeat))
+            if write_files and os.path.exists(path):
+                path = os.path.join(folder, "%d_IMG_%04d.JPG"
+                                    % (image, image % name_repeat))
+            if write_files:
+                f = open(path, "wb")
+                f.write(data)
+                f.close()
+            w('\t\t<key>%d</key>\n\t\t<dict>\n'
+              '\t\t\t<key>MediaType</key>\n\t\t\t<string>Image</string>\n'
+              '\t\t\t<key>Caption</key>\n\t\t\t<string>IMG_%04d</string>\n'
+              '\t\t\t<key>Comment</key>\n\t\t\t<string></string>\n'
+              '\t\t\t<key>GUID</key>\n\t\t\t<string>%032x</string>\n'
+              '\t\t\t<key>Rating</key>\n\t\t\t<integer>%d</integer>\n'
+              '\t\t\t<key>ImageType</key>\n\t\t\t<string>JPEG</string>\n'
+              '\t\t\t<key>DateAsTimerInterval</key>\n'
+              '\t\t\t<real>%d.000000</real>\n'
+              '\t\t\t<key>ImagePath</key>\n\t\t\t<string>%s</string>\n'
+              '\t\t\t<key>ThumbPath</key>\n\t\t\t<string>%s</string>\n'
+              % (image, image % name_repeat, rnd.getrandbits(128), image % 6,
+                 event_dates[event] + image, escape(path),
+                 escape(path.replace("Masters", "Thumbnails"))))
+            w('\t\t\t<key>Keywords</key>\n\t\t\t<array>\n')
+            for keyword in rnd.sample(range(keywords),
+                                      min(keywords, rnd.randrange(4))):
+                w('\t\t\t\t<string>%d</string>\n' % keyword)
+            w('\t\t\t</array>\n')
+            if faces and rnd.random() < 0.3:
+                w('\t\t\t<key>Faces</key>\n\t\t\t<array>\n')
+                for face in rnd.sample(range(faces),
+                                       min(faces, rnd.randrange(1, 3))):
+                    w('\t\t\t\t<dict>\n'
+                      '\t\t\t\t\t<key>face key</key>\n'
+                      '\t\t\t\t\t<integer>%d</integer>\n'
+                      '\t\t\t\t\t<key>rectangle</key>\n'
+                      '\t\t\t\t\t<string>{{0.1, 0.2}, {0.3, 0.4}}</string>\n'
+                      '\t\t\t\t</dict>\n' % face)
+                w('\t\t\t</array>\n')
+            w('\t\t</dict>\n')
+    w('\t</dict>\n</dict>\n</plist>\n')
+    out.close()
+
+
+def max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def count_fs_calls(counts):
+    """
+    Count the calls to the os functions that hit the filesystem for file
+    metadata (os.path.exists and friends go through os.stat) in counts.
+    """
+    def counted(func):
+        def call(*args, **kwargs):
+            counts[0] += 1
+            return func(*args, **kwargs)
+        return call
+    for name in ("stat", "lstat", "listdir", "scandir"):
+        if hasattr(os, name):
+            setattr(os, name, counted(getattr(os, name)))
+
+
+def read_album_data(exportiphoto, library_dir):
+    """
+    Read AlbumData.xml through exportiphoto's NUL-stripping reader, the
+    way the expat parser does, and return how long it took. The data is
+    checksummed so that every page of it is touched, as parsing would.
+    """
+    path = os.path.join(library_dir, "AlbumData.xml")
+    stream = exportiphoto.RemoveNullsStream(path)
+    if hasattr(stream, "chunks"):
+        chunks = stream.chunks(2**20)
+    else:
+        chunks = iter(lambda: stream.read(2**20), b"")
+    start = time.time()
+    crc = 0
+    for data in chunks:
+        crc = zlib.crc32(data, crc)
+    seconds = time.time() - start
+    stream.close()
+    return {"read_seconds": seconds,
+            "read_mb_per_second": os.path.getsize(path) / 1048576.0 / seconds}
+
+
+def run_case(case, library_dir, options):
+    """
+    Run one benchmark case in this process and return its results.
+    """
+    sys.path.insert(0, here)
+    import exportiphoto
+
+    result = {}
+    if case == "read":
+        # Only the reader, not the parser: big libraries take long to parse.
+        result.update(read_album_data(exportiphoto, library_dir))
+        result["max_rss_kb"] = max_rss_kb()
+        return result
+
+    dest_dir = tempfile.mkdtemp(prefix="exportiphoto-bench-")
+    try:
+        kwargs = dict(quiet=True, parser=options.get("parser", "expat"),
+                      use_album=options.get("albums", False), use_date=True,
+                      deconflict=True, jobs=options.get("jobs", 1))
+        start = time.time()
+        library = exportiphoto.iPhotoLibrary(library_dir, dest_dir, **kwargs)
+        result["parse_seconds"] = time.time() - start
+        result["images"] = len(library.images)
+
+        if case == "plan":
+            start = time.time()
+            result["plan_entries"] = len(library.plan())
+            result["plan_seconds"] = time.time() - start
+
+        elif case == "naming":
+            # Folder naming, with -i matching against a destination that
+            # already has a folder for every other event.
+            targets = [f[2] for f in library.folders()]
+            for target in targets[::2]:
+                if not os.path.exists(target):
+                    os.makedirs(target)
+            library = exportiphoto.iPhotoLibrary(
+                library_dir, dest_dir, import_missing=True, test=True,
+                **kwargs)
+            start = time.time()
+            result["folders"] = len(list(library.folders()))
+            result["naming_seconds"] = time.time() - start
+
+        elif case == "walk":
+            count = [0]
+            def visit(imageId, folderName, folderDate):
+                count[0] += 1
+            start = time.time()
+            library.walk([visit])
+            result["walk_seconds"] = time.time() - start
+            result["exports"] = count[0]
+
+        elif case in ("copy", "recopy"):
+            if case == "recopy":
+                library.walk([library.copyImage])
+                library.close()
+                library = exportiphoto.iPhotoLibrary(
+                    library_dir, dest_dir, **kwargs)
+            fs_calls = [0]
+            count_fs_calls(fs_calls)
+            start = time.time()
+            library.walk([library.copyImage])
+            library.close()
+            seconds = time.time() - start
+            result[case + "_fs_calls"] = fs_calls[0]
+            copied = 0
+            for dirpath, dirnames, filenames in os.walk(dest_dir):
+                for name in filenames:
+                    copied += os.path.getsize(os.path.join(dirpath, name))
+            result[case + "_seconds"] = seconds
+            if case == "copy":
+                result["copy_mb_per_second"] = copied / 1048576.0 / seconds
+    finally:
+        shutil.rmtree(dest_dir, ignore_errors=True)
+    result["max_rss_kb"] = max_rss_kb()
+    return result
+
+
+def run(library_dir, cases, options):
+    results = {
+        "python": sys.version.split()[0],
+        "commit": git_commit(),
+        "options": options,
+        "cases": {},
+    }
+    for case in cases:
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "case", case,
+             library_dir, json.dumps(options)],
+            stdout=subprocess.PIPE
+        )
+        output = proc.communicate()[0]
+        if proc.returncode:
+            sys.stderr.write("%s failed\n" % case)
+            continue
+        results["cases"][case] = json.loads(output.strip().splitlines()[-1])
+        report(case, results["cases"][case])
+    return results
+
+
+def report(case, result):
+    print("%-12s %s" % (case, "  ".join([
+        "%s=%s" % (k, isinstance(v, float) and "%.3f" % v or v)
+        for k, v in sorted(result.items())
+    ])))
+
+
+def compare(old, new):
+    print("old: %s  new: %s" % (old.get("commit"), new.get("commit")))
+    for case in sorted(new["cases"]):
+        if case not in old["cases"]:
+            continue
+        for key in sorted(new["cases"][case]):
+            a = old["cases"][case].get(key)
+            b = new["cases"][case][key]
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)) \
+                    and a:
+                print("%-12s %-22s %12.3f %12.3f %+7.1f%%" % (
+                    case, key, a, b, (b - a) * 100.0 / a))
+
+
+def git_commit():
+    try:
+        proc = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=here, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        return proc.communicate()[0].decode("ascii").strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    usage = __doc__.strip()
+    option_parser = OptionParser(usage=usage)
+    option_parser.set_defaults(images=1000, album_overlap=1.5, faces=50,
+                               keywords=100, image_size=4096, files=True,
+                               name_repeat=10000,
+                               parser="expat", albums=False, jobs=1)
+    option_parser.add_option("-n", "--images", type="int", dest="images",
+                             help="number of images to generate default=1000")
+    option_parser.add_option("--events", type="int", dest="events",
+                             help="number of events default=images/50")
+    option_parser.add_option("--album_count", type="int", dest="album_count",
+                             help="number of albums default=images/200")
+    option_parser.add_option("--album_overlap", type="float",
+                             dest="album_overlap",
+                             help="average number of albums per image default=1.5")
+    option_parser.add_option("--faces", type="int", dest="faces",
+                             help="number of faces default=50")
+    option_parser.add_option("--keywords", type="int", dest="keywords",
+                             help="number of keywords default=100")
+    option_parser.add_option("--image_size", type="int", dest="image_size",
+                             help="size of each image file in bytes default=4096")
+    option_parser.add_option("--name_repeat", type="int", dest="name_repeat",
+                             help="file names repeat every this many images default=10000")
+    option_parser.add_option("--no_files", action="store_false", dest="files",
+                             help="only write AlbumData.xml, not image files")
+    option_parser.add_option("-c", "--cases", dest="cases",
+                             help="comma-separated cases to run default=%s"
+                             % ",".join(default_cases))
+    option_parser.add_option("-a", "--albums", action="store_true",
+                             dest="albums", help="export albums instead of events")
+    option_parser.add_option("--parser", dest="parser",
+                             help="parser to benchmark default=expat")
+    option_parser.add_option("--jobs", type="int", dest="jobs",
+                             help="copy jobs default=1")
+    option_parser.add_option("-o", "--output", dest="output",
+                             help="save the results to this JSON file")
+    (options, args) = option_parser.parse_args()
+
+    if not args:
+        option_parser.error("Please specify a command.")
+    command, args = args[0], args[1:]
+
+    def generate(library_dir):
+        generate_library(library_dir, images=options.images,
+                         events=options.events, albums=options.album_count,
+                         album_overlap=options.album_overlap,
+                         faces=options.faces, keywords=options.keywords,
+                         image_size=options.image_size,
+                         write_files=options.files,
+                         name_repeat=options.name_repeat)
+
+    if command == "generate" and len(args) == 1:
+        generate(args[0])
+    elif command == "case" and len(args) == 3:
+        print(json.dumps(run_case(args[0], args[1], json.loads(args[2]))))
+    elif command == "run" and len(args) <= 1:
+        cases = (options.cases and options.cases.split(",")) or default_cases
+        case_options = {"parser": options.parser, "albums": options.albums,
+                        "jobs": options.jobs}
+        tmp_dir = None
+        if args:
+            library_dir = args[0]
+        else:
+            tmp_dir = library_dir = tempfile.mkdtemp(
+                prefix="exportiphoto-library-")
+            generate(library_dir)
+        try:
+            results = run(library_dir, cases, case_options)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        if options.output:
+            f = open(options.output, "w")
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.close()
+    elif command == "compare" and len(args) == 2:
+        compare(json.load(open(args[0])), json.load(open(args[1])))
+    else:
+        option_parser.error("Unknown command or wrong number of arguments.")
+
+
+if __name__ == '__main__':
+    main()
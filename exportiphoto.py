@@ -1,34 +1,81 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 
 __version__ = "0.6"
 
 import base64
 import codecs
+import errno
+import fnmatch
+import hashlib
 import io
+import json
 import locale
+import mmap
 import os
 import re
 import shutil
+import sqlite3
 import stat
+import subprocess
 import sys
+import threading
 
 import time
-from datetime import datetime
+import unicodedata
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
 from io import IOBase
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from xml.dom.pulldom import START_ELEMENT, END_ELEMENT, parse
 from xml.dom.minidom import Node
+from xml.parsers import expat
 
 try:
-    import pyexiv2
+    import cPickle as pickle
 except ImportError:
-    pyexiv2 = None
+    import pickle
 
-# To allow Unicode characters to be displayed
-# (see http://wiki.python.org/moin/PrintFails)
-sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout)
-sys.stderr = codecs.getwriter(locale.getpreferredencoding())(sys.stderr)
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if sys.version_info[0] < 3:
+    text_type = unicode
+else:
+    text_type = str
+    intern = sys.intern
+
+def toText(value):
+    """
+    Return value as text, decoding it from UTF-8 if it's bytes (e.g. a
+    file name from os.listdir, or an error message, on Python 2).
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def moduleAvailable(name):
+    """
+    Return True if module name can be imported, without importing it.
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+    return find_spec(name) is not None
 
 class iPhotoLibraryError(Exception):
     pass
@@ -36,33 +83,1485 @@ class iPhotoLibraryError(Exception):
 # Some AlbumData.xml files contain null bytes.  Strip them so the SAX parser
 # doesn't fail with an Invalid Token error.
 class RemoveNullsStream(IOBase):
+    """
+    Reads AlbumData.xml, leaving out the NUL bytes iPhoto sometimes pads
+    it with, which expat won't accept. chunks() maps the file a window at
+    a time where it can, so that chunks without NULs (usually all of them)
+    are handed to the parser without being copied; a chunk is only
+    copied, to strip them, if it has NULs in it.
+    """
+    # A multiple of mmap.ALLOCATIONGRANULARITY, and small enough that the
+    # mapped pages don't add much to the RSS.
+    window = 2**22
+
     def __init__(self, filename):
-        self.file = open(filename, 'r')
+        self.file = open(filename, 'rb')
+        self.map = None
 
     def read(self, bufsize=2**20):
-        return self.file.read(bufsize).translate(None,"\0")
+        while True:
+            data = self.file.read(bufsize)
+            if not data:
+                return data
+            # replace() returns data itself if it has no NULs.
+            data = data.replace(b"\0", b"")
+            # A chunk of nothing but NULs isn't the end of the file.
+            if data:
+                return data
+
+    def chunks(self, bufsize=2**20):
+        """
+        Generate the rest of the file, without NULs, in chunks of up to
+        bufsize bytes. A chunk may be a view of a mapped window of the
+        file, which stays mapped as long as the chunk is referenced.
+        """
+        offset = self.file.tell()
+        size = os.fstat(self.file.fileno()).st_size
+        if offset % mmap.ALLOCATIONGRANULARITY:
+            size = offset # read() has been used; carry on with it
+        while offset < size:
+            length = min(self.window, size - offset)
+            try:
+                self.map = mmap.mmap(self.file.fileno(), length,
+                                     access=mmap.ACCESS_READ, offset=offset)
+            except (ValueError, OverflowError, EnvironmentError):
+                break # not mappable; read it instead
+            try:
+                view = memoryview(self.map)
+            except TypeError:
+                # Python 2 maps can't be viewed, and search them a byte at
+                # a time, so reading is quicker there.
+                self.unmap()
+                break
+            pos = 0
+            while pos < length:
+                end = min(pos + bufsize, length)
+                if self.map.find(b"\0", pos, end) != -1:
+                    data = self.map[pos:end].replace(b"\0", b"")
+                    if data:
+                        yield data
+                else:
+                    yield view[pos:end]
+                pos = end
+            offset += length
+            self.file.seek(offset)
+            view.release()
+            self.unmap()
+        while True:
+            data = self.read(bufsize)
+            if not data:
+                return
+            yield data
+
+    def unmap(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass # a chunk is still in use; it goes when that does
+            self.map = None
 
     def close(self):
+        self.unmap()
+        self.file.close()
+
+class PlistStreamParser(object):
+    """
+    Turn the values in a (top-level dict) plist straight into Python data
+    as expat streams through the file, without building DOM nodes first.
+
+    whole and items map top-level keys to a list of interesting dict keys
+    (or None for all keys), with the same meaning as in
+    iPhotoLibrary.dePlist. The value of a key in whole is built and passed
+    to handler(top_key, None, value) in one go; for a key in items, each
+    member of its array or dict is passed on its own as
+    handler(top_key, item_key, value), so the container is never held in
+    memory. The values of all other top-level keys are skipped, as are
+    the members of a dict in items for which want(top_key, item_key), if
+    given, returns False.
+    """
+    leaf_types = frozenset(
+        ['key', 'string', 'integer', 'real', 'data', 'date']
+    )
+
+    def __init__(self, handler, whole, items, date_func, want=None):
+        self.handler = handler
+        self.want = want
+        self.whole = whole
+        self.items = items
+        self.date_func = date_func
+        self.depth = 0
+        self.skip = 0
+        self.top_key = None
+        self.item_key = None
+        self.item_filter = None
+        self.stack = [] # [type, value, last dict key, text, filter]
+
+    def parse(self, stream, bufsize=2**20):
+        for _ in self.parseChunks(stream, bufsize):
+            pass
+
+    def parseChunks(self, stream, bufsize=2**20):
+        """
+        Parse stream like parse, yielding after each chunk of bufsize so
+        the caller can act on what has been handled so far.
+        """
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.characters
+        try:
+            for data in stream.chunks(bufsize):
+                parser.Parse(data, False)
+                yield
+            parser.Parse("", True)
+        except expat.ExpatError as why:
+            raise iPhotoLibraryError("Corrupted Library; %s" % why)
+
+    def start(self, name, attrs):
+        if self.skip:
+            self.skip += 1
+            return
+        self.depth += 1
+        if self.stack:
+            frame = self.stack[-1]
+            ik = frame[4]
+            if frame[0] == 'dict' and name != 'key' and ik:
+                last_key = frame[2]
+                if last_key not in ik and not last_key.isdigit():
+                    self.skip = 1
+                    return
+            self.push(name, ik)
+        elif self.depth == 3:
+            if name == 'key':
+                self.push(name, None)
+            elif self.top_key in self.whole:
+                self.push(name, self.whole[self.top_key])
+            elif self.top_key in self.items:
+                self.item_filter = self.items[self.top_key]
+            else:
+                self.skip = 1
+        elif self.depth == 4:
+            if name != 'key' and self.want and \
+                    not self.want(self.top_key, self.item_key):
+                self.item_key = None
+                self.skip = 1
+                return
+            self.push(name, self.item_filter)
+
+    def push(self, name, ik):
+        if name == 'array':
+            value = []
+        elif name == 'dict':
+            value = {}
+        else:
+            value = None
+        if name in self.leaf_types:
+            text = []
+        else:
+            text = None
+        self.stack.append([name, value, None, text, ik])
+
+    def characters(self, data):
+        if self.stack:
+            text = self.stack[-1][3]
+            if text is not None:
+                text.append(data)
+
+    def end(self, name):
+        if self.skip:
+            self.skip -= 1
+            if not self.skip:
+                self.depth -= 1
+            return
+        self.depth -= 1
+        if not self.stack:
+            return
+        dtype, value, last_key, text, ik = self.stack.pop()
+        if text:
+            text = "".join(text)
+        else:
+            text = None
+        if dtype == 'key':
+            if self.stack:
+                self.stack[-1][2] = text
+            elif self.depth == 2:
+                self.top_key = text
+            else:
+                self.item_key = text
+            return
+        elif dtype in ('array', 'dict'):
+            pass
+        elif dtype == 'string':
+            value = text
+        elif dtype == 'integer':
+            try:
+                value = int(text)
+            except (ValueError, TypeError):
+                raise iPhotoLibraryError(
+                    "Corrupted Library; unexpected value '%s' for integer" % text)
+        elif dtype == 'real':
+            try:
+                value = float(text)
+            except (ValueError, TypeError):
+                raise iPhotoLibraryError(
+                    "Corrupted Library; unexpected value '%s' for real" % text)
+        elif dtype == 'true':
+            value = True
+        elif dtype == 'false':
+            value = False
+        elif dtype == 'data':
+            value = base64.b64decode(text or "")
+        elif dtype == 'date':
+            value = self.date_func(text)
+        else:
+            raise Exception("Don't know what a %s is." % dtype)
+
+        if self.stack:
+            parent = self.stack[-1]
+            if parent[0] == 'array':
+                parent[1].append(value)
+            else:
+                parent[1][intern(str(parent[2]))] = value
+        elif self.depth == 2:
+            self.handler(self.top_key, None, value)
+        else:
+            self.handler(self.top_key, self.item_key, value)
+            self.item_key = None
+
+class ImageRecord(object):
+    """
+    The interesting parts of one Master Image List entry, kept compactly:
+    paths are split so their directories can be shared with other images
+    through a string table, and keywords and faces are tuples of integer
+    IDs (indexes into the tables made by idTable). It can still be read
+    like the dict dePlist returns for the image, so image["ImagePath"],
+    "OriginalPath" in image and image.get("Faces", []) all work.
+    tags holds the image's keyword names once iPhotoLibrary.imageTags has
+    worked them out.
+    """
+    __slots__ = ('image_dir', 'image_name', 'original_dir', 'original_name',
+                 'caption', 'comment', 'rating', 'keywords', 'faces', 'tags')
+
+    def __init__(self, image, strings):
+        share = strings.setdefault
+        self.image_dir, self.image_name = self.splitPath(
+            image.get('ImagePath'), share)
+        self.original_dir, self.original_name = self.splitPath(
+            image.get('OriginalPath'), share)
+        self.caption = image.get('Caption')
+        self.comment = image.get('Comment')
+        self.rating = image.get('Rating')
+        keywords = image.get('Keywords')
+        if keywords is not None:
+            keywords = self.ids(keywords)
+        self.keywords = keywords
+        faces = image.get('Faces')
+        if faces is not None:
+            faces = self.ids([f.get('face key') for f in faces])
+        self.faces = faces
+        self.tags = None
+
+    @staticmethod
+    def ids(values):
+        ids = []
+        for value in values:
+            try:
+                ids.append(int(value))
+            except (TypeError, ValueError):
+                pass
+        return tuple(ids)
+
+    @staticmethod
+    def splitPath(path, share):
+        if path is None:
+            return None, None
+        dirname, basename = os.path.split(path)
+        return share(dirname, dirname), basename
+
+    def get(self, key, default=None):
+        if key == 'ImagePath':
+            if self.image_name is None:
+                return default
+            return os.path.join(self.image_dir, self.image_name)
+        elif key == 'OriginalPath':
+            if self.original_name is None:
+                return default
+            return os.path.join(self.original_dir, self.original_name)
+        elif key == 'Faces':
+            if self.faces is None:
+                return default
+            return [{'face key': f} for f in self.faces]
+        value = getattr(self, self.attributes.get(key, 'missing'), None)
+        if value is None:
+            return default
+        return value
+
+    attributes = {
+        'Caption': 'caption',
+        'Comment': 'comment',
+        'Rating': 'rating',
+        'Keywords': 'keywords',
+    }
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getstate__(self):
+        return tuple([getattr(self, a) for a in self.__slots__[:-1]])
+
+    def __setstate__(self, state):
+        for a, value in zip(self.__slots__[:-1], state):
+            setattr(self, a, value)
+        self.tags = None
+
+def idTable(names):
+    """
+    Turn a {ID: name} dict from AlbumData.xml (List of Keywords or List of
+    Faces, whose IDs are small numbers, as strings) into a list of the
+    names indexed by ID, with None for unused IDs. Should the IDs be
+    sparse, it stays a dict, keyed by the numbers instead.
+    """
+    table = {}
+    for key, name in names.items():
+        try:
+            table[int(key)] = name
+        except ValueError:
+            pass
+    if not table or min(table) < 0 or max(table) > 4 * len(table) + 1024:
+        return table
+    names = [None] * (max(table) + 1)
+    for i, name in table.items():
+        names[i] = name
+    return names
+
+def tagName(table, tagId):
+    """
+    Look tagId up in a table from idTable, returning None if it isn't
+    there.
+    """
+    try:
+        return table[tagId]
+    except (IndexError, KeyError):
+        return None
+
+class Checkpoint(object):
+    """
+    A journal of the files whose export (copy, and metadata if any) has
+    finished, kept in the destination while an export runs so that an
+    interrupted one can be resumed without checking those files again.
+    A file is only journaled once it is complete, so one that was being
+    written when the export died is redone. The journal is removed when
+    an export finishes.
+    """
+    filename = ".exportiphoto-checkpoint"
+    sync_interval = 5
+    # On resume, re-check this many of the last journaled files against
+    # their sources, in case the disk lost writes the journal didn't.
+    verify_tail = 16
+
+    def __init__(self, destDir, resume=False, suffix=""):
+        self.dest_dir = destDir
+        self.path = os.path.join(destDir, self.filename + suffix)
+        self.done = set()
+        if resume:
+            self.load()
+        try:
+            if not os.path.exists(destDir):
+                os.makedirs(destDir)
+            if resume:
+                self.file = open(self.path, 'a')
+                if self.file.tell():
+                    # Don't glue the first new entry onto a torn last line.
+                    self.file.write("\n")
+            else:
+                self.file = open(self.path, 'w')
+        except (IOError, OSError) as why:
+            raise iPhotoLibraryError(
+                "Can't write checkpoint %s: %s" % (self.path, why))
+        self.last_sync = time.time()
+
+    def key(self, tFilePath):
+        return os.path.relpath(tFilePath, self.dest_dir)
+
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+        entries = []
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue # torn or blank line
+        f.close()
+        for target, source in entries[:-self.verify_tail]:
+            self.done.add(target)
+        for target, source in entries[-self.verify_tail:]:
+            try:
+                if os.path.getsize(os.path.join(self.dest_dir, target)) == \
+                        os.path.getsize(source):
+                    self.done.add(target)
+            except (OSError, TypeError):
+                pass
+
+    def isDone(self, tFilePath):
+        return self.key(tFilePath) in self.done
+
+    def record(self, tFilePath, mFilePath):
+        self.file.write(json.dumps([self.key(tFilePath), mFilePath]) + "\n")
+        if time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+
+    def close(self, finished=False):
+        if self.file is None:
+            return
+        self.sync()
         self.file.close()
+        self.file = None
+        if finished:
+            os.remove(self.path)
+
+class NameIndex(object):
+    """
+    The names already handed out in one directory (or, for folders, in
+    dest_dir), with the next suffix to try for each name, so deconflicting
+    the nth copy of a name doesn't have to probe the n-1 taken before it.
+    """
+    def __init__(self):
+        self.used = set()
+        self.next_suffix = {}
+
+    def claim(self, name, variant):
+        """
+        Return name, or if it's taken, the first of variant(1),
+        variant(2), ... that isn't, and mark it as taken.
+        """
+        claimed = name
+        if claimed in self.used:
+            j = self.next_suffix.get(name, 1)
+            claimed = variant(j)
+            while claimed in self.used:
+                j += 1
+                claimed = variant(j)
+            self.next_suffix[name] = j + 1
+        self.used.add(claimed)
+        return claimed
+
+class DirectoryScan(object):
+    """
+    Answers whether files exist, and their stat, from one listing of each
+    directory they're in rather than an exists() call per file: on a
+    network drive every call is a round trip. Files are only stat'ed when
+    their stat is asked for, and then only once (with os.scandir, where
+    there is one, the listing may already have it). At most limit
+    directories are kept, the oldest being forgotten first.
+    """
+    def __init__(self, limit=None):
+        self.dirs = OrderedDict()
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name):
+        # HFS+ lists names decomposed; AlbumData.xml has them composed.
+        if isinstance(name, text_type):
+            return unicodedata.normalize("NFC", name)
+        return name
+
+    def entries(self, dirName):
+        entries = self.dirs.get(dirName)
+        if entries is not None:
+            return entries
+        entries = {}
+        try:
+            if hasattr(os, "scandir"):
+                for entry in os.scandir(dirName):
+                    entries[self.key(entry.name)] = entry
+            else:
+                for name in os.listdir(dirName):
+                    entries[self.key(name)] = None
+        except OSError:
+            pass
+        with self.lock:
+            self.dirs[dirName] = entries
+            while self.limit and len(self.dirs) > self.limit:
+                self.dirs.popitem(last=False)
+        return entries
+
+    def stat(self, path):
+        """
+        Return the stat of path, or None if it doesn't exist.
+        """
+        dirName, name = os.path.split(path)
+        entries = self.entries(dirName)
+        name = self.key(name)
+        if name not in entries:
+            return None
+        st = entries[name]
+        if not isinstance(st, os.stat_result):
+            try:
+                if st is None:
+                    st = os.stat(path)
+                else:
+                    st = st.stat()
+            except OSError:
+                return None
+            entries[name] = st
+        return st
+
+    def record(self, path, st):
+        """
+        Note that path has been written, with stat st.
+        """
+        dirName, name = os.path.split(path)
+        entries = self.dirs.get(dirName)
+        if entries is not None:
+            entries[self.key(name)] = st
+
+    def forget(self, dirName):
+        with self.lock:
+            self.dirs.pop(dirName, None)
+
+# ioctl request number for cloning a file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """
+    Make dst a copy-on-write clone of src, with src's times and mode as
+    shutil.copy2 would set them. Raises IOError or OSError if the
+    filesystem (or platform) can't do it.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks aren't supported here")
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        finally:
+            fdst.close()
+    except:
+        fsrc.close()
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    fsrc.close()
+    shutil.copystat(src, dst)
+
+class FileCopier(object):
+    """
+    Copies files like shutil.copy2, but lets the kernel move the data when
+    it can: as a reflink (a copy-on-write clone) if the filesystem
+    supports it, otherwise with copy_file_range or sendfile, and only
+    failing those through Python's buffers. A strategy that turns out not
+    to work here (any error the first time it's used, or one of the
+    unsupported errors later) isn't tried again, and a copy it leaves
+    short is made again the next way. Times and mode are always copied
+    with shutil.copystat, so the mtime-based skip check works the same way.
+
+    The kernel copies are only used on Linux: elsewhere sendfile (where
+    there is one, e.g. macOS) only writes to sockets.
+    """
+    kernel_strategies = ["copy_file_range", "sendfile"]
+    # Errors meaning "this strategy can't be used for these files".
+    unsupported = set([errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                       errno.EINVAL, errno.ENOSYS, errno.EBADF])
+    chunk_size = 2**30
+
+    def __init__(self, method="auto"):
+        strategies = []
+        if method == "auto" and fcntl and sys.platform.startswith("linux"):
+            strategies.append("reflink")
+        if method in ("auto", "kernel") and sys.platform.startswith("linux"):
+            strategies.extend([s for s in self.kernel_strategies
+                               if hasattr(os, s)])
+        self.strategies = strategies
+        self.proven = set()
+
+    def copy(self, src, dst):
+        """
+        Copy src to dst, returning the name of the strategy that did it.
+        """
+        for strategy in list(self.strategies):
+            try:
+                if strategy == "reflink":
+                    reflink(src, dst)
+                elif not self.kernelCopy(strategy, src, dst):
+                    continue
+                else:
+                    shutil.copystat(src, dst)
+                self.proven.add(strategy)
+                return strategy
+            except (IOError, OSError) as why:
+                # A missing file isn't the strategy's fault.
+                if why.errno == errno.ENOENT or (
+                        strategy in self.proven and
+                        why.errno not in self.unsupported):
+                    raise
+                self.strategies = [s for s in self.strategies
+                                   if s != strategy]
+        shutil.copy2(src, dst)
+        return "python"
+
+    def kernelCopy(self, strategy, src, dst):
+        """
+        Copy src to dst with strategy, returning False if it stopped short
+        of src's size.
+        """
+        fsrc = open(src, 'rb')
+        try:
+            fdst = open(dst, 'wb')
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    count = min(size - offset, self.chunk_size)
+                    if strategy == "copy_file_range":
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                               count)
+                    else:
+                        n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset,
+                                        count)
+                    if not n:
+                        break
+                    offset += n
+            finally:
+                fdst.close()
+        finally:
+            fsrc.close()
+        return offset >= size
+
+class CopyScheduler(object):
+    """
+    Paces copies for shared storage: keeps them under max_rate bytes and
+    max_ops files per second (either may be None), letting up to burst
+    seconds' worth through at once, and, if adaptive is True, varies how
+    many run at the same time between 1 and jobs, keeping whatever number
+    gets the most bytes through.
+
+    Every copy calls start(size) before it and done(size) after it;
+    start blocks until the copy may go ahead. Concurrency is adjusted
+    every interval seconds by hill climbing: a step that made throughput
+    go up is taken again, one that made it go down is undone, and if it
+    made no difference a copy is taken away, to go easy on the storage.
+    """
+    interval = 2.0
+    burst = 1.0
+
+    def __init__(self, jobs=1, max_rate=None, max_ops=None, adaptive=False):
+        self.cond = threading.Condition()
+        self.jobs = jobs
+        self.max_rate = max_rate
+        self.max_ops = max_ops
+        self.adaptive = adaptive and jobs > 1
+        if self.adaptive:
+            self.limit = max(1, jobs // 2)
+        else:
+            self.limit = jobs
+        self.step = 1
+        self.active = 0
+        self.byte_clock = self.op_clock = time.time()
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.last_rate = None
+        self.rate = 0.0
+        self.throttled = 0.0
+        self.limits_used = set([self.limit])
+
+    def start(self, size):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            now = time.time()
+            begin = now
+            if self.max_rate:
+                clock = max(self.byte_clock, now - self.burst)
+                begin = max(begin, clock)
+                self.byte_clock = clock + size / float(self.max_rate)
+            if self.max_ops:
+                clock = max(self.op_clock, now - self.burst)
+                begin = max(begin, clock)
+                self.op_clock = clock + 1.0 / self.max_ops
+            if begin > now:
+                self.throttled += begin - now
+        if begin > now:
+            time.sleep(begin - now)
+
+    def done(self, size):
+        with self.cond:
+            self.active -= 1
+            self.window_bytes += size
+            now = time.time()
+            elapsed = now - self.window_start
+            if elapsed >= self.interval:
+                self.rate = self.window_bytes / elapsed
+                if self.adaptive:
+                    self.adjust()
+                self.window_start = now
+                self.window_bytes = 0
+            self.cond.notify_all()
+
+    def adjust(self):
+        if self.last_rate:
+            change = (self.rate - self.last_rate) / self.last_rate
+            if change < -0.05:
+                self.step = -self.step
+            elif change < 0.05:
+                self.step = -1
+        self.last_rate = self.rate
+        self.limit = min(max(self.limit + self.step, 1), self.jobs)
+        self.limits_used.add(self.limit)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "copying": self.active,
+                "concurrency": self.limit,
+                "bytes_per_second": self.rate,
+                "throttled_seconds": self.throttled,
+            }
+
+class ExportManifest(object):
+    """
+    A record of every file exported to a destination directory, with the
+    size and modification time its source had when it was copied. It is
+    kept in an SQLite database in the destination, and loaded in one go,
+    so re-runs can skip unchanged images without stat-ing their copies.
+
+    Note that a copy deleted from the destination by hand won't be
+    noticed while its manifest entry is still current.
+    """
+    filename = ".exportiphoto.sqlite"
+    commit_interval = 1000
+
+    def __init__(self, destDir, readonly=False, suffix=""):
+        self.dest_dir = destDir
+        self.readonly = readonly
+        self.entries = {}
+        self.db = None
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        path = self.path(destDir, suffix)
+        if suffix:
+            # A shard keeps its own manifest, so shards don't wait on each
+            # other's writes, but starts from the merged one.
+            self.entries.update(self.read(self.path(destDir)))
+        if readonly and not os.path.exists(path):
+            return
+        try:
+            if not os.path.exists(destDir):
+                os.makedirs(destDir)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS exported ("
+                "target TEXT PRIMARY KEY, source TEXT, size INTEGER, mtime REAL)"
+            )
+            for target, source, size, mtime in self.db.execute(
+                    "SELECT target, source, size, mtime FROM exported"):
+                self.entries[target] = (source, size, mtime)
+        except (OSError, sqlite3.Error) as why:
+            raise iPhotoLibraryError(
+                "Can't open manifest %s: %s" % (path, why))
+
+    @classmethod
+    def path(cls, destDir, suffix=""):
+        root, ext = os.path.splitext(cls.filename)
+        return os.path.join(destDir, root + suffix + ext)
+
+    @staticmethod
+    def read(path):
+        """
+        Return the entries of the manifest at path, if there is one.
+        """
+        entries = {}
+        if not os.path.exists(path):
+            return entries
+        try:
+            db = sqlite3.connect(path)
+            try:
+                for target, source, size, mtime in db.execute(
+                        "SELECT target, source, size, mtime FROM exported"):
+                    entries[target] = (source, size, mtime)
+            finally:
+                db.close()
+        except sqlite3.Error as why:
+            raise iPhotoLibraryError(
+                "Can't read manifest %s: %s" % (path, why))
+        return entries
+
+    def merge(self, suffix):
+        """
+        Add the entries of a shard's manifest to this one, and remove it.
+        """
+        path = self.path(self.dest_dir, suffix)
+        for target, entry in self.read(path).items():
+            if self.entries.get(target) != entry and self.db is not None:
+                self.entries[target] = entry
+                self.db.execute(
+                    "INSERT OR REPLACE INTO exported VALUES (?, ?, ?, ?)",
+                    (target,) + entry
+                )
+        if self.db is not None:
+            self.db.commit()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def key(self, tFilePath):
+        return os.path.relpath(tFilePath, self.dest_dir)
+
+    def unchanged(self, tFilePath, mFilePath, mStat):
+        """
+        Return True if tFilePath was exported from mFilePath when it had
+        the same size and modification time as mStat.
+        """
+        return self.entries.get(self.key(tFilePath)) == \
+            (mFilePath, mStat.st_size, mStat.st_mtime)
+
+    def record(self, tFilePath, mFilePath, mStat):
+        if self.readonly or self.db is None:
+            return
+        key = self.key(tFilePath)
+        entry = (mFilePath, mStat.st_size, mStat.st_mtime)
+        with self.lock:
+            if self.entries.get(key) == entry:
+                return
+            self.entries[key] = entry
+            self.db.execute(
+                "INSERT OR REPLACE INTO exported VALUES (?, ?, ?, ?)",
+                (key,) + entry
+            )
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+class VerifyIndex(object):
+    """
+    The checksums of the files found intact by earlier --verify
+    --checksums runs, kept in the manifest's database in the destination
+    with the sizes and modification times the files had then, so that a
+    file is only read again once it or its source has changed. For the
+    copy, its inode and change time are kept too: those can't be set back
+    the way the modification time can, so a copy that was changed and had
+    its time restored (e.g. with touch -r) is still read again.
+    """
+    commit_interval = 1000
+
+    def __init__(self, destDir, suffix=""):
+        self.dest_dir = destDir
+        self.uncommitted = 0
+        path = ExportManifest.path(destDir, suffix)
+        try:
+            if not os.path.exists(destDir):
+                os.makedirs(destDir)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS verified ("
+                "target TEXT PRIMARY KEY, source TEXT, source_size INTEGER, "
+                "source_mtime REAL, target_size INTEGER, target_mtime REAL, "
+                "target_ctime REAL, target_ino INTEGER, digest TEXT)"
+            )
+        except (OSError, sqlite3.Error) as why:
+            raise iPhotoLibraryError(
+                "Can't open manifest %s: %s" % (path, why))
+
+    def key(self, tFilePath):
+        return os.path.relpath(tFilePath, self.dest_dir)
+
+    def lookup(self, tFilePath, mFilePath, mStat, tStat):
+        """
+        Return the checksum of mFilePath if it hasn't changed since it was
+        last verified (or None), and whether tFilePath hasn't either.
+        """
+        row = self.db.execute(
+            "SELECT source, source_size, source_mtime, target_size, "
+            "target_mtime, target_ctime, target_ino, digest FROM verified "
+            "WHERE target = ?",
+            (self.key(tFilePath),)
+        ).fetchone()
+        if row is None or \
+                tuple(row[:3]) != (mFilePath, mStat.st_size, mStat.st_mtime):
+            return None, False
+        return row[7], tuple(row[3:7]) == (tStat.st_size, tStat.st_mtime,
+                                           tStat.st_ctime, tStat.st_ino)
+
+    def record(self, tFilePath, mFilePath, mStat, tStat, digest):
+        self.db.execute(
+            "INSERT OR REPLACE INTO verified VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.key(tFilePath), mFilePath, mStat.st_size, mStat.st_mtime,
+             tStat.st_size, tStat.st_mtime, tStat.st_ctime, tStat.st_ino,
+             digest)
+        )
+        self.changed()
+
+    def forget(self, tFilePath):
+        self.db.execute("DELETE FROM verified WHERE target = ?",
+                        (self.key(tFilePath),))
+        self.changed()
+
+    def changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def fileDigest(path, chunk_size=2**20):
+    """
+    Return the MD5 checksum of the file at path, reading it in chunks.
+    """
+    digest = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+class ImportIndex(object):
+    """
+    The dated folders found in each directory of the destination by the
+    last -i scan, kept in the destination with each directory's
+    modification time, so that only directories that have changed since
+    (usually just this year's) are listed again. A directory whose time
+    was too close to its scan to tell later changes apart is always
+    listed again.
+    """
+    filename = ".exportiphoto-import-index"
+    version = 1
+    # Seconds; HFS+ keeps times to the second.
+    granularity = 2
+
+    def __init__(self, destDir, date_delimiter):
+        self.dest_dir = destDir
+        self.path = os.path.join(destDir, self.filename)
+        self.date_delimiter = date_delimiter
+        self.dirs = {}
+        self.seen = {}
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+        try:
+            try:
+                index = json.load(f)
+            except ValueError:
+                return
+        finally:
+            f.close()
+        if index.get("version") == self.version and \
+                index.get("date_delimiter") == date_delimiter:
+            self.dirs = index.get("dirs", {})
+
+    def folders(self, baseDir, scan):
+        """
+        Return the folders in baseDir, as scan(baseDir) returns them if
+        the directory has changed since it was last scanned.
+        """
+        key = os.path.relpath(baseDir, self.dest_dir)
+        mtime = os.stat(baseDir).st_mtime
+        entry = self.dirs.get(key)
+        if entry and entry["mtime"] == mtime and \
+                mtime < entry["scanned"] - self.granularity:
+            folders = entry["folders"]
+            if str is bytes:
+                # Python 2 lists byte strings, which json saves as UTF-8
+                # and gives back as unicode.
+                for folder in folders:
+                    folder[0] = folder[0].encode("utf-8")
+        else:
+            entry = {"mtime": mtime, "scanned": time.time(),
+                     "folders": scan(baseDir)}
+            folders = entry["folders"]
+        self.seen[key] = entry
+        return folders
+
+    def save(self):
+        """
+        Save the directories scanned this time, forgetting any others.
+        """
+        try:
+            f = open(self.path, 'w')
+            try:
+                json.dump({"version": self.version,
+                           "date_delimiter": self.date_delimiter,
+                           "dirs": self.seen}, f)
+            finally:
+                f.close()
+        except (IOError, OSError) as why:
+            raise iPhotoLibraryError(
+                "Can't write import index %s: %s" % (self.path, why))
+
+class Pyexiv2Writer(object):
+    """
+    Writes metadata to image files with pyexiv2, one file at a time.
+    """
+    name = "pyexiv2"
+
+    def __init__(self, test=False):
+        # Imported only when it's used, as it's slow to load.
+        import pyexiv2
+        if not hasattr(pyexiv2, "ImageMetadata"):
+            raise iPhotoLibraryError(
+                "The pyexiv2 module installed (%s) isn't the one exportiphoto "
+                "uses; try --metadata_backend exiftool." % pyexiv2.__file__)
+        self.pyexiv2 = pyexiv2
+        self.test = test
+
+    @staticmethod
+    def available():
+        return moduleAvailable("pyexiv2")
+
+    def write(self, filePath, caption, rating, comment, keywords):
+        md = self.pyexiv2.ImageMetadata(filePath)
+        md.read()
+        if caption:
+            md["Iptc.Application2.Headline"] = [caption]
+        if rating:
+            md["Xmp.xmp.Rating"] = rating
+        if comment:
+            md["Iptc.Application2.Caption"] = [comment]
+        if keywords:
+            md["Iptc.Application2.Keywords"] = list(keywords)
+        if not self.test:
+            md.write(preserve_timestamps=True)
+
+    def close(self):
+        pass
+
+class ExiftoolWriter(object):
+    """
+    Writes metadata to image files through long-running exiftool processes
+    (-stay_open), so the cost of starting exiftool is paid once per worker
+    thread rather than once per file.
+    """
+    name = "exiftool"
+
+    def __init__(self, test=False):
+        self.test = test
+        self.local = threading.local()
+        self.processes = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return which("exiftool") is not None
+
+    def process(self):
+        proc = getattr(self.local, 'process', None)
+        if proc is None:
+            try:
+                proc = subprocess.Popen(
+                    ["exiftool", "-stay_open", "True", "-@", "-"],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT
+                )
+            except OSError as why:
+                raise iPhotoLibraryError("Can't run exiftool: %s" % why)
+            self.local.process = proc
+            with self.lock:
+                self.processes.append(proc)
+        return proc
+
+    @staticmethod
+    def escape(value):
+        # Arguments are read one per line; -E decodes these entities.
+        return text_type(value).replace(u"&", u"&amp;") \
+            .replace(u"\n", u"&#xa;").replace(u"\r", u"&#xd;")
+
+    def write(self, filePath, caption, rating, comment, keywords):
+        if self.test:
+            return
+        args = [u"-overwrite_original", u"-P", u"-E", u"-charset", u"iptc=UTF8",
+                u"-IPTC:CodedCharacterSet=UTF8"]
+        if caption:
+            args.append(u"-IPTC:Headline=" + self.escape(caption))
+        if rating:
+            args.append(u"-XMP-xmp:Rating=%d" % rating)
+        if comment:
+            args.append(u"-IPTC:Caption-Abstract=" + self.escape(comment))
+        for keyword in keywords:
+            args.append(u"-IPTC:Keywords=" + self.escape(keyword))
+        if isinstance(filePath, bytes):
+            filePath = filePath.decode(sys.getfilesystemencoding())
+        args.extend([filePath, u"-execute"])
+
+        proc = self.process()
+        proc.stdin.write((u"\n".join(args) + u"\n").encode("utf-8"))
+        proc.stdin.flush()
+        output = []
+        while True:
+            line = proc.stdout.readline()
+            if not line:
+                raise IOError("exiftool exited unexpectedly")
+            line = line.decode("utf-8", "replace")
+            if line.strip() == "{ready}":
+                break
+            output.append(line.strip())
+        errors = [l for l in output if l.startswith("Error")]
+        if errors:
+            raise IOError("; ".join(errors))
+
+    def close(self):
+        with self.lock:
+            for proc in self.processes:
+                try:
+                    proc.stdin.write(b"-stay_open\nFalse\n")
+                    proc.stdin.close()
+                    proc.wait()
+                except (IOError, OSError):
+                    pass
+            self.processes = []
+
+metadata_writers = {}
+default_metadata_backend = None
+if ExiftoolWriter.available():
+    metadata_writers[ExiftoolWriter.name] = ExiftoolWriter
+    default_metadata_backend = ExiftoolWriter.name
+if Pyexiv2Writer.available():
+    metadata_writers[Pyexiv2Writer.name] = Pyexiv2Writer
+    # On Python 3, a pyexiv2 module is usually an unrelated library of the
+    # same name, so exiftool is preferred there.
+    if sys.version_info[0] < 3 or default_metadata_backend is None:
+        default_metadata_backend = Pyexiv2Writer.name
+
+class Metrics(object):
+    """
+    Timers and counters for each phase of an export (parsing, planning,
+    stat-ing, copying, writing metadata), used for the summary printed at
+    the end, the throughput and ETA shown for each folder and, if log is
+    a file, a JSON line of progress every interval seconds. If copies go
+    through a CopyScheduler, scheduler is set to it and queue to a
+    function returning how many exports are outstanding, and the queue
+    and the copies in flight are reported too.
+    """
+    def __init__(self, log=None, interval=10):
+        self.lock = threading.Lock()
+        self.phases = []
+        self.totals = {}
+        self.counters = {}
+        self.log = log
+        self.interval = interval
+        self.started = time.time()
+        self.last_logged = 0
+        self.images_total = 0
+        self.images_done = 0
+        self.walk_started = None
+        self.first_done = None
+        self.scheduler = None
+        self.queue = None
+
+    def add(self, phase, seconds, filePath=None):
+        """
+        Record that one item of phase (e.g. one file's copy) took seconds.
+        """
+        with self.lock:
+            if phase not in self.totals:
+                self.phases.append(phase)
+                self.totals[phase] = [0, 0.0, 0.0, None]
+            total = self.totals[phase]
+            total[0] += 1
+            total[1] += seconds
+            if seconds >= total[2]:
+                total[2] = seconds
+                total[3] = filePath
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def startWalk(self, images_total):
+        self.images_total = images_total
+        self.walk_started = time.time()
+
+    def imageDone(self, result):
+        if self.first_done is None:
+            self.first_done = time.time() - self.started
+        self.images_done += 1
+        self.count({"-": "skipped", ".": "copied", "+": "copied",
+                    "=": "linked"}.get(result, "other"))
+        if self.log and time.time() - self.last_logged >= self.interval:
+            self.write("progress")
+
+    def throughput(self):
+        """
+        Return (images per second, bytes per second, seconds remaining)
+        since the walk started.
+        """
+        elapsed = time.time() - (self.walk_started or self.started)
+        if not elapsed or not self.images_done:
+            return 0.0, 0.0, None
+        images_rate = self.images_done / elapsed
+        bytes_rate = self.counters.get("bytes_copied", 0) / elapsed
+        remaining = (self.images_total - self.images_done) / images_rate
+        return images_rate, bytes_rate, max(remaining, 0)
+
+    def progress(self):
+        images_rate, bytes_rate, remaining = self.throughput()
+        if remaining is None:
+            return ""
+        if self.scheduler:
+            scheduler = self.scheduler.stats()
+            queue = ", %i queued, %i of %i copying at %.1f MB/s" % (
+                max(self.queue() - scheduler["copying"], 0),
+                scheduler["copying"],
+                scheduler["concurrency"],
+                scheduler["bytes_per_second"] / 1048576)
+        else:
+            queue = ""
+        return " [%i of %i images, %.1f images/s, %.1f MB/s, ETA %s%s]" % (
+            self.images_done, self.images_total, images_rate,
+            bytes_rate / 1048576, formatSeconds(remaining), queue)
+
+    def snapshot(self, event):
+        images_rate, bytes_rate, remaining = self.throughput()
+        if self.scheduler:
+            scheduler = self.scheduler.stats()
+            scheduler["queued"] = max(self.queue() - scheduler["copying"], 0)
+        else:
+            scheduler = None
+        with self.lock:
+            return {
+                "event": event,
+                "time": time.time(),
+                "elapsed": time.time() - self.started,
+                "images_total": self.images_total,
+                "images_done": self.images_done,
+                "images_per_second": images_rate,
+                "bytes_per_second": bytes_rate,
+                "eta_seconds": remaining,
+                "first_image_seconds": self.first_done,
+                "counters": dict(self.counters),
+                "phases": dict([
+                    (phase, {"count": t[0], "seconds": t[1]})
+                    for phase, t in self.totals.items()
+                ]),
+                "scheduler": scheduler,
+            }
+
+    def write(self, event):
+        self.last_logged = time.time()
+        self.log.write(json.dumps(self.snapshot(event)) + "\n")
+        self.log.flush()
+
+    def summary(self):
+        lines = []
+        for phase in self.phases:
+            count, seconds, slowest, slowest_file = self.totals[phase]
+            if slowest_file:
+                lines.append(
+                    "  %s: %i files in %.1fs (%.1f ms/file, slowest %.1f ms: %s)\n"
+                    % (phase, count, seconds, seconds * 1000 / count,
+                       slowest * 1000, slowest_file)
+                )
+            else:
+                lines.append("  %s: %.1fs\n" % (phase, seconds))
+        for counter in sorted(self.counters):
+            lines.append("  %s: %i\n" % (counter.replace("_", " "),
+                                         self.counters[counter]))
+        if "copy" in self.totals and self.totals["copy"][1]:
+            lines.append("  copy throughput: %.1f MB/s\n" % (
+                self.counters.get("bytes_copied", 0) / 1048576.0 /
+                self.totals["copy"][1]))
+        if self.first_done is not None:
+            lines.append("  first image done after %.1fs\n" % self.first_done)
+        if self.scheduler:
+            limits = sorted(self.scheduler.limits_used)
+            lines.append("  copies held back for %.1fs, %i to %i at a time\n"
+                         % (self.scheduler.throttled, limits[0], limits[-1]))
+        images_rate, bytes_rate, remaining = self.throughput()
+        lines.append("  %.1f images/s, %.1f MB/s\n" % (
+            images_rate, bytes_rate / 1048576))
+        return "".join(lines)
+
+    def close(self):
+        if self.log:
+            self.write("done")
+            self.log.close()
+            self.log = None
+
+def formatSeconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+# One image to export: where from, where to, and whether it is a link to
+# an earlier export of the same master and needs its metadata written.
+PlanEntry = namedtuple(
+    'PlanEntry', ['image_id', 'source', 'target', 'link_to', 'metadata']
+)
+
+# One image of the library, as generated by iPhotoLibrary.iterImages: its
+# file in the library, the directory it would be exported to, the date of
+# its event (None for albums) and the names of its keywords and faces.
+LibraryImage = namedtuple(
+    'LibraryImage',
+    ['image_id', 'source_path', 'target_dir', 'folder_date', 'tags']
+)
+
+class ExportStream(object):
+    """
+    Lets an export start while AlbumData.xml is still being parsed: the
+    file is parsed a chunk at a time, and after each chunk the events (or
+    albums) whose images have all been read are exported before parsing
+    goes on. That keeps the parse and the export in step without a second
+    thread competing for the interpreter, and images are dropped once
+    every folder they're in has been exported.
+
+    iPhoto writes the Master Image List after the events and albums, so
+    folders become ready one after another as it is read.
+    """
+    def __init__(self, library):
+        self.library = library
+        self.ready = deque()
+        self.folders = None
+        self.waiting = {}
+        self.missing = []
+        self.uses = {}
+        self.started = False
+
+    def start(self):
+        """
+        Work out the folders to export, now that the events (or albums)
+        have all been read, and which images each one is waiting for.
+        """
+        library = self.library
+        self.folders = list(library.folders())
+        for i, folder in enumerate(self.folders):
+            missing = 0
+            for imageId in set(folder[3]):
+                self.uses[imageId] = self.uses.get(imageId, 0) + 1
+                if imageId not in library.images:
+                    self.waiting.setdefault(imageId, []).append(i)
+                    missing += 1
+            self.missing.append(missing)
+            if not missing:
+                self.ready.append(i)
+        if library.metrics:
+            library.metrics.startWalk(
+                sum([len(folder[3]) for folder in self.folders]))
+
+    def wantImage(self, imageId):
+        if self.folders is None:
+            if not self.library.albums_seen:
+                return True
+            self.start()
+        return imageId in self.waiting
+
+    def imageStored(self, imageId):
+        for i in self.waiting.pop(imageId, ()):
+            self.missing[i] -= 1
+            if not self.missing[i]:
+                self.ready.append(i)
+
+    def finish(self):
+        """
+        Make the folders that are still waiting for images, which weren't
+        in the Master Image List, ready.
+        """
+        if self.folders is None:
+            self.start()
+        for i, missing in enumerate(self.missing):
+            if missing:
+                self.ready.append(i)
+
+    def __iter__(self):
+        """
+        Parse the library, generating the folders as they become ready,
+        like iPhotoLibrary.folders does.
+        """
+        if self.started:
+            raise iPhotoLibraryError(
+                "A library loaded with stream=True can only be walked once.")
+        self.started = True
+        parse_time = 0.0
+        start = time.time()
+        for _ in self.library.streamAlbumData():
+            parse_time += time.time() - start
+            while self.ready:
+                yield self.folders[self.ready.popleft()]
+            start = time.time()
+        self.finish()
+        parse_time += time.time() - start
+        if self.library.metrics:
+            self.library.metrics.add("parse", parse_time)
+        while self.ready:
+            yield self.folders[self.ready.popleft()]
+
+    def release(self, images):
+        """
+        Forget the images of a folder that has been exported, unless they
+        are still to be exported to another one.
+        """
+        for imageId in set(images):
+            self.uses[imageId] -= 1
+            if not self.uses[imageId]:
+                del self.uses[imageId]
+                self.library.images.pop(imageId, None)
 
 class iPhotoLibrary(object):
     def __init__(self, albumDir, destDir, use_album=False, use_date=False,
                  use_faces=False, use_metadata=False, deconflict=False, quiet=False,
                  year_dir=False, import_missing=False, import_from_date=None, test=False,
-                 date_delimiter="-", ignore_time_delta=False, originals=False):
+                 date_delimiter="-", ignore_time_delta=False, originals=False,
+                 jobs=1, use_manifest=False, parser="expat", cache_file=None,
+                 select=None, from_date=None, to_date=None,
+                 metadata_backend=None, timings=False, link_mode="copy",
+                 metrics_file=None, resume=False, copy_method="auto",
+                 stream=False, shard=None, max_rate=None, max_ops=None,
+                 adaptive_jobs=False):
         self.use_album = use_album
         self.use_date =  use_date
         self.use_faces = use_faces
         self.use_metadata = use_metadata
         self.deconflict = deconflict
         self.dest_dir = destDir
-        self.output_dirs = set()
-        self.output_files = set()
+        self.output_dirs = NameIndex()
+        self.output_files = {}
         self.quiet = quiet
         self.albums = []
-        self.keywords = {}
-        self.faces = {}
+        self.keywords = []
+        self.faces = []
+        self.tag_sets = {}
+        # Faces are only needed to write them as keywords.
+        self.want_faces = use_faces and use_metadata
+        if self.want_faces:
+            self.image_keys = self.interesting_image_keys
+        else:
+            self.image_keys = [k for k in self.interesting_image_keys
+                               if k not in ('Faces', 'face key')]
         self.images = {}
+        self.strings = {}
         self.test = test
         self.year_dir = year_dir
         self.import_missing = import_missing
@@ -70,6 +1569,70 @@ class iPhotoLibrary(object):
         self.date_delimiter = date_delimiter
         self.originals=originals
         self.import_albums = []
+        self.import_album_names = {}
+        self.date_names = {}
+        self.select = [p.lower() for p in select or []]
+        self.from_date = self.parseDateOption(from_date)
+        self.to_date = self.parseDateOption(to_date)
+        self.selective = bool(self.select or self.from_date or self.to_date)
+        self.albums_seen = 0
+        self.wanted_images = set()
+        self.shard = shard
+        if shard:
+            suffix = "-%iof%i" % shard
+            self.shard_targets = []
+        else:
+            suffix = ""
+            self.shard_targets = None
+        self.link_mode = link_mode
+        self.copier = FileCopier(copy_method)
+        self.source_files = DirectoryScan(limit=64)
+        self.target_files = DirectoryScan()
+        self.folders_made = set()
+        self.exported = {}
+        self.jobs = jobs
+        self.pending = deque()
+        if jobs > 1:
+            self.pool = ThreadPool(jobs)
+        else:
+            self.pool = None
+        if use_metadata:
+            backend = metadata_backend or default_metadata_backend
+            if backend not in metadata_writers:
+                raise iPhotoLibraryError(
+                    "The %s metadata backend isn't available." % backend)
+            self.metadata_writer = metadata_writers[backend](test=test)
+        else:
+            self.metadata_writer = None
+        if timings or metrics_file:
+            log = None
+            if metrics_file:
+                try:
+                    log = open(metrics_file, 'a')
+                except IOError as why:
+                    raise iPhotoLibraryError(
+                        "Can't open %s: %s" % (metrics_file, why))
+            self.metrics = Metrics(log)
+        else:
+            self.metrics = None
+        if (max_rate or max_ops or adaptive_jobs) and not test:
+            self.scheduler = CopyScheduler(jobs, max_rate, max_ops,
+                                           adaptive_jobs)
+            if self.metrics:
+                self.metrics.scheduler = self.scheduler
+                self.metrics.queue = self.queueDepth
+        else:
+            self.scheduler = None
+        self.show_timings = timings
+        if test:
+            self.checkpoint = None
+        else:
+            self.checkpoint = Checkpoint(destDir, resume, suffix)
+        if use_manifest:
+            self.manifest = ExportManifest(destDir, readonly=test,
+                                           suffix=suffix)
+        else:
+            self.manifest = None
 
         if import_from_date:
             self.import_from_date = datetime.strptime(import_from_date, "%Y-%m-%d")
@@ -79,20 +1642,65 @@ class iPhotoLibrary(object):
         if self.import_missing:
             self.build_import_list()
 
+        if stream:
+            # The library is parsed during walk.
+            self.album_dir = albumDir
+            self.stream = ExportStream(self)
+            return
+        self.stream = None
+        start = time.time()
+        self.load(albumDir, parser, cache_file)
+        if self.metrics:
+            self.metrics.add("parse", time.time() - start)
+
+    def load(self, albumDir, parser="expat", cache_file=None):
+        """
+        Load the library's AlbumData.xml, from cache_file if it's current.
+        """
         albumDataXml = os.path.join(albumDir, "AlbumData.xml")
+        if cache_file and self.loadCache(cache_file, albumDataXml):
+            return
         albumDataStream = RemoveNullsStream(albumDataXml)
         self.status("* Parsing iPhoto Library data... ")
-        self.parseAlbumData(albumDataStream)
+        if parser == "expat":
+            self.parseAlbumDataExpat(albumDataStream)
+        else:
+            self.parseAlbumData(albumDataStream)
         albumDataStream.close()
+        if self.selective:
+            self.pruneImages()
         self.status("Done.\n")
+        if cache_file:
+            self.saveCache(cache_file, albumDataXml)
+
+    def streamAlbumData(self, bufsize=2**16):
+        """
+        Parse AlbumData.xml for ExportStream, yielding after each chunk.
+        """
+        albumDataStream = RemoveNullsStream(
+            os.path.join(self.album_dir, "AlbumData.xml"))
+        try:
+            for _ in self.albumDataParser().parseChunks(albumDataStream,
+                                                        bufsize):
+                yield
+        finally:
+            albumDataStream.close()
+
+    # Folder names of unnamed events ("Jun 10, 2009") and of folders that
+    # already start with a date ("2009-06-10 Party").
+    unnamed_event_re = re.compile("[A-Z][a-z]{2} [0-9]{1,2}, [0-9]{4}")
+    dated_folder_re = re.compile("[0-9]{4}.[0-9]{2}.[0-9]{2} ?.*")
+    year_dir_re = re.compile("^[0-9]{4}$")
 
     major_version = 2
     minor_version = 0
+    cache_version = 2
+    plan_version = 1
     interesting_image_keys = [
         'OriginalPath', 'ImagePath', 'Rating', 'Keywords', 'Caption', 'Comment', 'Faces',
         'face key'
     ]
-    apple_epoch = 978307200
+    apple_epoch = datetime(2001, 1, 1)
 
     def parseAlbumData(self, filename):
         """
@@ -117,22 +1725,22 @@ class iPhotoLibrary(object):
                         stack.pop()
                     elif last_top_key == 'List of Keywords':
                         doc.expandNode(node)
-                        self.keywords = self.dePlist(node)
+                        self.keywords = idTable(self.dePlist(node))
                         stack.pop()
-                    elif last_top_key == 'List of Faces':
+                    elif last_top_key == 'List of Faces' and self.want_faces:
                         doc.expandNode(node)
-                        self.faces = dict([
+                        self.faces = idTable(dict([
                             (k, v['name']) for k,v in
                              self.dePlist(node, ['name']).items()
-                        ])
+                        ]))
                         stack.pop()
                     elif last_top_key == 'Major Version':
                         doc.expandNode(node)
                         major_version = self.dePlist(node)
                         stack.pop()
                         if major_version != self.major_version:
-                            raise iPhotoLibraryError, \
-                            "Sorry, I can't understand version %i iPhoto Libraries." % major_version
+                            raise iPhotoLibraryError(
+                                "Sorry, I can't understand version %i iPhoto Libraries." % major_version)
                     elif last_top_key == 'Minor Version':
                         doc.expandNode(node)
                         minor_version = self.dePlist(node)
@@ -148,20 +1756,204 @@ class iPhotoLibrary(object):
                     # load them all into memory.
                     if last_top_key == album_list_key:
                         doc.expandNode(node)
-                        self.albums.append(self.dePlist(node))
+                        self.storeAlbum(self.dePlist(node))
                         stack.pop()
                     elif last_top_key == 'Master Image List':
                         doc.expandNode(node)
                         if node.nodeName == 'key':
                             last_image_key = self.getText(node)
                         else:
-                            self.images[last_image_key] = self.dePlist(
-                                node, self.interesting_image_keys
-                            )
+                            self.storeImage(last_image_key, self.dePlist(
+                                node, self.image_keys
+                            ))
                         stack.pop()
             elif event == END_ELEMENT:
                 stack.pop()
 
+    def parseAlbumDataExpat(self, stream):
+        """
+        Parse an iPhoto AlbumData.xml file like parseAlbumData does, but
+        with PlistStreamParser, which is much faster and lighter on memory
+        for large libraries.
+        """
+        self.albumDataParser().parse(stream)
+
+    def albumDataParser(self):
+        """
+        Return the PlistStreamParser that parseAlbumDataExpat uses.
+        """
+        if self.use_album:
+            album_list_key = "List of Albums"
+        else:
+            album_list_key = "List of Rolls"
+
+        def handle(top_key, key, value):
+            if top_key == 'Master Image List':
+                self.storeImage(key, value)
+            elif top_key == album_list_key:
+                self.storeAlbum(value)
+            elif top_key == 'List of Keywords':
+                self.keywords = idTable(value)
+            elif top_key == 'List of Faces':
+                self.faces = idTable(
+                    dict([(k, v['name']) for k, v in value.items()]))
+            elif top_key == 'Major Version':
+                if value != self.major_version:
+                    raise iPhotoLibraryError(
+                        "Sorry, I can't understand version %i iPhoto Libraries." % value)
+            elif top_key == 'Minor Version':
+                if value > self.minor_version:
+                    self.status(
+                        "\nI don't recognise iPhoto libraries when the minor version is %i, but let's try anyway.\n" % value,
+                        force=True
+                    )
+
+        whole = {
+            'List of Keywords': None,
+            'Major Version': None,
+            'Minor Version': None,
+        }
+        if self.want_faces:
+            whole['List of Faces'] = ['name']
+        return PlistStreamParser(
+            handle,
+            whole=whole,
+            items={
+                album_list_key: None,
+                'Master Image List': self.image_keys,
+            },
+            date_func=self.appleDate,
+            want=lambda top_key, key: top_key != 'Master Image List' or
+                                      self.wantImage(key),
+        )
+
+    def cacheKey(self, albumDataXml):
+        """
+        Identify the parse results for albumDataXml: they can be reused as
+        long as the file and the options that affect parsing are the same.
+        """
+        st = os.stat(albumDataXml)
+        return (self.cache_version, sys.version_info[0],
+                os.path.abspath(albumDataXml),
+                st.st_size, st.st_mtime, self.use_album, self.select,
+                self.from_date, self.to_date, self.want_faces)
+
+    def loadCache(self, cache_file, albumDataXml):
+        """
+        Load the parsed library from cache_file if it was saved for the
+        current albumDataXml. Return True if it was.
+        """
+        try:
+            f = open(cache_file, 'rb')
+        except IOError:
+            return False
+        try:
+            try:
+                if pickle.load(f) != self.cacheKey(albumDataXml):
+                    return False
+                self.status("* Loading cached iPhoto Library data... ")
+                self.albums, self.images, self.keywords, self.faces = \
+                    pickle.load(f)
+            except (EOFError, ValueError, TypeError, AttributeError,
+                    pickle.UnpicklingError):
+                self.albums, self.images, self.keywords, self.faces = \
+                    [], {}, [], []
+                return False
+        finally:
+            f.close()
+        self.status("Done.\n")
+        return True
+
+    def saveCache(self, cache_file, albumDataXml):
+        """
+        Save the parsed library to cache_file for loadCache.
+        """
+        tmp_file = cache_file + ".tmp"
+        try:
+            f = open(tmp_file, 'wb')
+            try:
+                pickle.dump(self.cacheKey(albumDataXml), f,
+                            pickle.HIGHEST_PROTOCOL)
+                pickle.dump((self.albums, self.images, self.keywords,
+                             self.faces), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as why:
+            self.status("Can't save cache %s: %s\n" % (cache_file, why),
+                        force=True)
+
+    def storeImage(self, imageId, image):
+        if not self.wantImage(imageId):
+            return
+        imageId = self.strings.setdefault(imageId, imageId)
+        self.images[imageId] = ImageRecord(image, self.strings)
+        if self.stream:
+            self.stream.imageStored(imageId)
+
+    def storeAlbum(self, album):
+        self.albums_seen += 1
+        if self.selective:
+            if not self.selectFolder(album):
+                return
+            self.wanted_images.update(album.get("KeyList", []))
+        share = self.strings.setdefault
+        if "KeyList" in album:
+            album["KeyList"] = [share(k, k) for k in album["KeyList"]]
+        self.albums.append(album)
+
+    def wantImage(self, imageId):
+        """
+        Return False if imageId is known not to be in any selected event or
+        album. Until the album list has been seen, every image is wanted;
+        pruneImages drops the unwanted ones afterwards.
+        """
+        if self.stream:
+            return self.stream.wantImage(imageId)
+        return not self.selective or not self.albums_seen or \
+            imageId in self.wanted_images
+
+    def pruneImages(self):
+        for imageId in list(self.images.keys()):
+            if imageId not in self.wanted_images:
+                del self.images[imageId]
+
+    def selectFolder(self, folder):
+        """
+        Return True if folder (an event or album) matches the select,
+        from_date and to_date options. Dates only apply to events.
+        """
+        if self.use_album:
+            if folder.get("Album Type", None) != "Regular":
+                return False
+            name = folder.get("AlbumName")
+        else:
+            name = folder.get("RollName")
+            if self.from_date or self.to_date:
+                day = self.appleDate(folder["RollDateAsTimerInterval"]).date()
+                if self.from_date and day < self.from_date.date():
+                    return False
+                if self.to_date and day > self.to_date.date():
+                    return False
+        if self.select:
+            name = (name or "").lower()
+            for pattern in self.select:
+                if fnmatch.fnmatchcase(name, pattern):
+                    break
+            else:
+                return False
+        return True
+
+    @staticmethod
+    def parseDateOption(text):
+        if not text:
+            return None
+        try:
+            return datetime.strptime(text, "%Y-%m-%d")
+        except ValueError:
+            raise iPhotoLibraryError(
+                "Invalid date '%s'; use YYYY-MM-DD." % text)
+
     def dePlist(self, node, interesting_keys=None):
         """
         Given a DOM node, convert the plist (fragment) it refers to and
@@ -179,16 +1971,16 @@ class iPhotoLibrary(object):
             try:
                 return int(self.getText(node))
             except ValueError:
-                raise iPhotoLibraryError, \
-                "Corrupted Library; unexpected value '%s' for integer" % \
-                    self.getText(node)
+                raise iPhotoLibraryError(
+                    "Corrupted Library; unexpected value '%s' for integer" %
+                    self.getText(node))
         elif dtype == 'real':
             try:
                 return float(self.getText(node))
             except ValueError:
-                raise iPhotoLibraryError, \
-                "Corrupted Library; unexpected value '%s' for real" % \
-                    self.getText(node)
+                raise iPhotoLibraryError(
+                    "Corrupted Library; unexpected value '%s' for real" %
+                    self.getText(node))
         elif dtype == 'array':
             return [self.dePlist(c, ik) for c in node.childNodes \
                     if c.nodeType == Node.ELEMENT_NODE]
@@ -213,11 +2005,11 @@ class iPhotoLibrary(object):
         elif dtype == 'false':
             return False
         elif dtype == 'data':
-            return base64.decodestring(self.getText(c))
+            return base64.b64decode(self.getText(c))
         elif dtype == 'date':
             return self.appleDate(self.getText(c))
         else:
-            raise Exception, "Don't know what a %s is." % dtype
+            raise Exception("Don't know what a %s is." % dtype)
 
     @staticmethod
     def getText(element, default=None):
@@ -228,85 +2020,223 @@ class iPhotoLibrary(object):
         else:
             return "".join([n.nodeValue for n in element.childNodes])
 
-    def walk(self, funcs):
+    def folders(self):
         """
-        Walk through the events or albums (depending on the value of albums)
-        in this library and apply each function in the list funcs to each
-        image, calling it as:
-           func(folderName, folderDate, imageId)
-        where:
-         - folderName is the name the folder,
-         - folderDate is the date of the folder, and
-         - imageId is the string identifier for the image.
+        Generate the events or albums (depending on the value of use_album)
+        to export, as (folderName, folderDate, targetFileDir, imageIds)
+        tuples, where:
+         - folderName is the name of the event or album,
+         - folderDate is its date (None for albums),
+         - targetFileDir is the (deconflicted) directory to export it to, and
+         - imageIds are the string identifiers of its images.
+        Each call hands out the deconflicted names afresh, so every pass
+        gives the same ones.
+        """
+        self.output_dirs = NameIndex()
+        self.output_files = {}
+        for folder in self.exportedAlbums():
+            folderName, folderDate, outputPath = self.outputPath(folder)
+            images = folder["KeyList"]
+
+            #as we process albums/events in the iPhoto library, remove that album
+            #from the list of import_albums we'll be importing at the end
+            self.markFound(folderName)
+
+            # Deconflict output directories
+            targetFileDir = os.path.join(self.dest_dir, outputPath)
+            if self.deconflict:
+                targetFileDir = self.output_dirs.claim(
+                    targetFileDir,
+                    lambda j: os.path.join(self.dest_dir, outputPath + " %02d"%j)
+                )
+
+            # Every shard names every folder, so deconflicted names are
+            # the same whichever shard exports them.
+            if not self.inShard(outputPath):
+                continue
+
+            yield folderName, folderDate, targetFileDir, images
+
+            # Deconflicted folders never share a directory, so nothing else
+            # will be exported to this one.
+            self.output_files.pop(targetFileDir, None)
+
+    def markFound(self, folderName):
+        """
+        Note that the destination folders folderName could have been
+        exported to are in the library, so -i doesn't import them.
+        """
+        for ia in self.import_album_names.pop(folderName, ()):
+            ia["found"] = True
+
+    def exportedAlbums(self):
+        if self.use_album:
+            return [a for a in self.albums if
+                    a.get("Album Type", None) == "Regular"]
+        return self.albums
+
+    def outputPath(self, folder):
+        """
+        Return the name and date of an event or album, and the path
+        (relative to dest_dir, before deconflicting) to export it to.
         """
         if self.use_album:
-            targetName = "AlbumName"
-            albums = [a for a in self.albums if
-                      a.get("Album Type", None) == "Regular"]
+            folderName = folder["AlbumName"]
+            folderDate = None
         else:
-            targetName = "RollName"
-            albums = self.albums
-        i = 0
-        for folder in albums:
-            i += 1
-            if self.use_album:
-                folderDate = None
+            folderName = folder["RollName"]
+            folderDate = self.appleDate(folder["RollDateAsTimerInterval"])
+
+        if folderDate and self.use_date:
+            date = self.formatDate(folderDate)
+            if self.unnamed_event_re.match(folderName):
+                outputPath = date
+            elif self.dated_folder_re.match(folderName):
+                outputPath = folderName
             else:
-                folderDate = self.appleDate(folder["RollDateAsTimerInterval"])
-            images = folder["KeyList"]
+                outputPath = date + " " + folderName
+            if self.year_dir:
+                outputPath = os.path.join(str(folderDate.year), outputPath)
+        else:
+            outputPath = folderName
+        return folderName, folderDate, outputPath
 
-            folderName = folder[targetName]
+    def inShard(self, outputPath):
+        """
+        Return True if the folder exported to outputPath belongs to this
+        shard. Folders are split by a hash of that path, so every host
+        agrees on the split and folders that share a directory (without
+        -x) are exported by the same shard.
+        """
+        if not self.shard:
+            return True
+        i, n = self.shard
+        digest = hashlib.md5(outputPath.encode("utf-8")).hexdigest()
+        return int(digest[:8], 16) % n == i - 1
 
-            #as we process albums/events in the iPhoto library, remove that album
-            #from the list of import_albums we'll be importing at the end
-            if self.import_albums:
-                for ia in self.import_albums:
-                    for album_name in ia['album_names']:
-                        album_name = unicode(album_name, 'utf-8')
-                        if folderName == album_name:
-                            self.import_albums.remove(ia)
-
-            if folderDate and self.use_date:
-                date = '%(year)d%(delim)s%(month)02d%(delim)s%(day)02d' % {
+    def shardAlbums(self):
+        albums = self.exportedAlbums()
+        if not self.shard:
+            return albums
+        return [a for a in albums if self.inShard(self.outputPath(a)[2])]
+
+    def formatDate(self, folderDate):
+        """
+        Return folderDate as a folder name prefix, e.g. "2009-06-10".
+        """
+        day = folderDate.date()
+        date = self.date_names.get(day)
+        if date is None:
+            date = self.date_names[day] = \
+                '%(year)d%(delim)s%(month)02d%(delim)s%(day)02d' % {
                     'year': folderDate.year,
                     'month': folderDate.month,
                     'day': folderDate.day,
                     'delim': self.date_delimiter
                 }
-                if re.match("[A-Z][a-z]{2} [0-9]{1,2}, [0-9]{4}", folderName):
-                    outputPath = date
-                elif re.match("[0-9]{4}.[0-9]{2}.[0-9]{2} ?.*", folderName):
-                    outputPath = folderName
-                else:
-                    outputPath = date + " " + folderName
-                if self.year_dir:
-                    outputPath = os.path.join(str(folderDate.year), outputPath)
-            else:
-                outputPath = folderName
+        return date
 
-            # Deconflict output directories
-            targetFileDir = os.path.join(self.dest_dir, outputPath)
-            if self.deconflict:
-                j = 1
-                while targetFileDir in self.output_dirs:
-                    targetFileDir = os.path.join(self.dest_dir, outputPath + " %02d"%j)
-                    j += 1
-                self.output_dirs.add(targetFileDir)
+    def folderCount(self):
+        return len(self.shardAlbums())
 
-            self.status("* Processing %i of %i: %s (%i images)...\n" % (
+    def walk(self, funcs):
+        """
+        Walk through the events or albums (depending on the value of albums)
+        in this library and apply each function in the list funcs to each
+        image, calling it as:
+           func(imageId, targetFileDir, folderDate)
+        where:
+         - imageId is the string identifier for the image,
+         - targetFileDir is the directory to export the folder to, and
+         - folderDate is the date of the folder.
+        """
+        count = None
+        i = 0
+        for folderName, folderDate, targetFileDir, images in \
+                self.walkFolders():
+            if count is None:
+                count = self.folderCount()
+            i += 1
+            if self.metrics:
+                progress = self.metrics.progress()
+            else:
+                progress = ""
+            self.status("* Processing %i of %i: %s (%i images)...%s\n" % (
                 i,
-                len(albums),
+                count,
                 folderName,
-                len(images)
+                len(images),
+                progress
             ))
             for imageId in images:
                 for func in funcs:
                     func(imageId, targetFileDir, folderDate)
+            self.flushCopies()
             self.status("\n")
 
+        self.importMissing()
+
+    def walkFolders(self):
+        """
+        Generate the folders to export like folders() does (parsing the
+        library as it goes, if stream is True), tidying up after each one
+        once the caller has moved on to the next.
+        """
+        if self.stream:
+            self.status("* Parsing iPhoto Library data while exporting...\n")
+            folders = self.stream
+        else:
+            if self.metrics:
+                self.metrics.startWalk(
+                    sum([len(f["KeyList"]) for f in self.shardAlbums()]))
+            folders = self.folders()
+        for folder in folders:
+            yield folder
+            folderName, folderDate, targetFileDir, images = folder
+            self.flushCopies()
+            self.target_files.forget(targetFileDir)
+            if self.stream:
+                self.stream.release(images)
+                self.output_files.pop(targetFileDir, None)
+
+    def iterImages(self):
+        """
+        Generate a LibraryImage for each image to export, folder by folder
+        in walk order, without exporting anything, so that other programs
+        can import this module and do their own thing with the images:
+
+            library = iPhotoLibrary(albumDir, destDir, test=True, quiet=True)
+            for image in library.iterImages():
+                ...
+
+        An image in several albums is generated once for each. Nothing is
+        worked out before it's asked for, so stopping early is cheap; with
+        stream=True, images come out while the library is still being
+        parsed, but it can then only be gone through once. tags includes
+        faces only if use_faces and use_metadata are both True, as faces
+        aren't read otherwise.
+        """
+        for folderName, folderDate, targetFileDir, images in \
+                self.walkFolders():
+            for imageId in images:
+                try:
+                    image = self.images[imageId]
+                except KeyError:
+                    raise iPhotoLibraryError("Can't find image #%s" % imageId)
+                yield LibraryImage(imageId, self.sourcePath(image),
+                                   targetFileDir, folderDate,
+                                   self.imageTags(image))
+
+    def importMissing(self):
+        """
+        Import the folders in dest_dir that weren't found in the library
+        (if import_missing is True) into iPhoto.
+        """
         if self.import_missing: 
             self.status("importing folders:\n")
             for ia in self.import_albums:
+                if ia.get("found"):
+                    continue
                 self.status(ia["album_dir"] + "\n")
 
                 #using the "Auto Import" dir in iPhoto was unpredictable with respect to the resulting event name.
@@ -320,75 +2250,615 @@ tell application "iPhoto"
 end tell
 ' ''' % escaped_dir)
 
-    def copyImage(self, imageId, folderName, folderDate):
+    def plan(self):
         """
-        Copy an image from the library to a folder in the dest_dir. The
-        name of the folder is based on folderName and folderDate; if
-        folderDate is None, it's only based upon the folderName.
+        Work out where every image will be exported to, without touching
+        the destination, and return it as a list of PlanEntry tuples in
+        walk order.
+        """
+        start = time.time()
+        entries = list(self.planEntries())
+        if self.metrics:
+            self.metrics.add("plan", time.time() - start)
+        return entries
 
-        If use_metadata is True, also write the image metadata from the library
-        to the copy. If use_faces is True, faces will be saved as keywords.
+    def planEntries(self):
+        """
+        Generate the PlanEntry tuples of plan() one at a time.
+        """
+        for folderName, folderDate, targetFileDir, images in self.folders():
+            for imageId in images:
+                mFilePath, tFilePath = self.targetPath(imageId, targetFileDir)
+                first = self.firstExport(mFilePath, tFilePath)
+                if first:
+                    linkTo = first[0]
+                else:
+                    linkTo = None
+                yield PlanEntry(imageId, mFilePath, tFilePath, linkTo,
+                                self.use_metadata and not linkTo)
+
+    def writePlan(self, entries, filename):
+        """
+        Save a plan from plan() to filename, one JSON list per line after a
+        header line.
         """
         try:
-            image = self.images[imageId]
-        except KeyError:
-            raise iPhotoLibraryError, "Can't find image #%s" % imageId
+            f = open(filename, 'w')
+            try:
+                f.write(json.dumps({
+                    "exportiphoto_plan": self.plan_version,
+                    "dest_dir": os.path.abspath(self.dest_dir),
+                }) + "\n")
+                for entry in entries:
+                    f.write(json.dumps(list(entry)) + "\n")
+            finally:
+                f.close()
+        except IOError as why:
+            raise iPhotoLibraryError("Can't write plan %s: %s" % (filename, why))
+
+    def readPlan(self, filename):
+        """
+        Load a plan saved by writePlan.
+        """
+        try:
+            f = open(filename)
+        except IOError as why:
+            raise iPhotoLibraryError("Can't read plan %s: %s" % (filename, why))
+        try:
+            try:
+                header = json.loads(f.readline())
+                if header.get("exportiphoto_plan") != self.plan_version:
+                    raise ValueError("unknown plan version")
+                destDir = header.get("dest_dir")
+                if not destDir or os.path.abspath(destDir) != \
+                        os.path.abspath(self.dest_dir):
+                    raise ValueError("it exports to %s" % destDir)
+                entries = [PlanEntry(*json.loads(line)) for line in f]
+            except (ValueError, TypeError) as why:
+                raise iPhotoLibraryError(
+                    "Can't read plan %s: %s" % (filename, why))
+        finally:
+            f.close()
+        # Metadata is written (or not) by use_metadata, so it has to agree
+        # with the plan; links never write it.
+        if not self.use_metadata and [e for e in entries if e.metadata]:
+            raise iPhotoLibraryError(
+                "The plan %s writes metadata; use -m." % filename)
+        if self.use_metadata and \
+                [e for e in entries if not e.metadata and not e.link_to]:
+            raise iPhotoLibraryError(
+                "The plan %s doesn't write metadata; don't use -m." % filename)
+        return entries
+
+    def execute(self, entries, small_first=False):
+        """
+        Apply a plan from plan() or readPlan(). Copies are made in order of
+        their source paths, so reads from the library are mostly
+        sequential, or, if small_first is True, smallest first, so most of
+        the images are done early and big videos come last. Links to
+        earlier copies are made once every copy is done. Re-applying a
+        plan skips the files that are already up to date, so an
+        interrupted export can be resumed this way.
+
+        Each destination directory's listing is dropped once all of its
+        entries are done, as walk() does after each folder.
+        """
+        remaining = {}
+        for entry in entries:
+            directory = os.path.dirname(entry.target)
+            remaining[directory] = remaining.get(directory, 0) + 1
+        for directory in sorted(remaining):
+            self.makeFolder(directory)
+
+        copies = sorted([e for e in entries if not e.link_to],
+                        key=lambda e: e.source)
+        if small_first:
+            copies.sort(key=self.sourceSize)
+        links = [e for e in entries if e.link_to]
+        if self.metrics:
+            self.metrics.startWalk(len(entries))
+        self.status("* Exporting %i images...\n" % len(entries))
+        for batch in (copies, links):
+            for entry in batch:
+                self.exportEntry(entry)
+                directory = os.path.dirname(entry.target)
+                remaining[directory] -= 1
+                if not remaining[directory]:
+                    # Its copies may still be stat'ing it on the pool.
+                    self.flushCopies()
+                    self.target_files.forget(directory)
+            self.flushCopies()
+        self.status("\n")
+        if self.import_missing:
+            # A plan read from a file hasn't been through folders(), which
+            # is where the library's folders are matched against the
+            # destination's.
+            for folder in self.exportedAlbums():
+                self.markFound(self.outputPath(folder)[0])
+        self.importMissing()
+
+    def verify(self, checksums=False):
+        """
+        Check every file the export would write against its source, and
+        return the problems found as a dict of lists of paths:
+         - missing: copies that aren't there,
+         - missing master: sources that aren't there or can't be read,
+         - stale: copies older than their source or (unless use_metadata
+           is True) a different size, and
+         - corrupt: copies whose checksum differs from their source's.
+        Checksums are only compared if checksums is True (and use_metadata
+        isn't, as writing metadata changes the file); they are computed on
+        the pool, if there is one, and stored in a VerifyIndex so
+        unchanged files aren't read again next time.
+        """
+        problems = {"missing": [], "missing master": [], "stale": [],
+                    "corrupt": []}
+        if checksums and not self.use_metadata:
+            if self.shard:
+                index = VerifyIndex(self.dest_dir, "-%iof%i" % self.shard)
+            else:
+                index = VerifyIndex(self.dest_dir)
+        else:
+            index = None
+        self.status("* Verifying export...\n")
+        pending = deque()
+        count = 0
+        lastDir = None
+        try:
+            for entry in self.planEntries():
+                count += 1
+                targetDir = os.path.dirname(entry.target)
+                if targetDir != lastDir:
+                    self.target_files.forget(lastDir)
+                    lastDir = targetDir
+                mStat = self.source_files.stat(entry.source)
+                tStat = self.target_files.stat(entry.target)
+                if mStat is None:
+                    problems["missing master"].append(entry.source)
+                    continue
+                if tStat is None:
+                    problems["missing"].append(entry.target)
+                    continue
+                if (not self.ignore_time_delta and
+                        mStat.st_mtime > tStat.st_mtime + 10) or \
+                        (not self.use_metadata and
+                         mStat.st_size != tStat.st_size):
+                    problems["stale"].append(entry.target)
+                    continue
+                if index is None:
+                    continue
+                digest, unchanged = index.lookup(entry.target, entry.source,
+                                                 mStat, tStat)
+                if unchanged:
+                    continue
+                args = (entry.source, entry.target, digest)
+                if self.pool:
+                    result = self.pool.apply_async(self.compareDigests, args)
+                else:
+                    result = None
+                pending.append((result, args, mStat, tStat))
+                while pending and (len(pending) > self.jobs * 4 or
+                                   pending[0][0] is None or
+                                   pending[0][0].ready()):
+                    self.verified(index, problems, *pending.popleft())
+            while pending:
+                self.verified(index, problems, *pending.popleft())
+        finally:
+            if index:
+                index.close()
+        self.status("* Verified %i files: %s.\n" % (count, ", ".join([
+            "%i %s" % (len(problems[k]), k) for k in sorted(problems)
+        ])), force=True)
+        return problems
+
+    def compareDigests(self, mFilePath, tFilePath, mDigest=None):
+        """
+        Return the checksums of mFilePath (unless mDigest is already
+        known) and tFilePath. If mFilePath can't be read, both are None.
+        """
+        start = time.time()
+        if mDigest is None:
+            try:
+                mDigest = fileDigest(mFilePath)
+            except (IOError, OSError):
+                return None, None
+        tDigest = fileDigest(tFilePath)
+        if self.metrics:
+            self.metrics.add("checksum", time.time() - start, tFilePath)
+        return mDigest, tDigest
+
+    def verified(self, index, problems, result, args, mStat, tStat):
+        mFilePath, tFilePath, mDigest = args
+        try:
+            if result is None:
+                mDigest, tDigest = self.compareDigests(*args)
+            else:
+                mDigest, tDigest = result.get()
+        except (IOError, OSError):
+            problems["missing"].append(tFilePath)
+            return
+        if mDigest is None:
+            problems["missing master"].append(mFilePath)
+            return
+        if mDigest == tDigest:
+            index.record(tFilePath, mFilePath, mStat, tStat, mDigest)
+        else:
+            index.forget(tFilePath)
+            problems["corrupt"].append(tFilePath)
+
+    def sourceSize(self, entry):
+        st = self.source_files.stat(entry.source)
+        if st is None:
+            return 0
+        return st.st_size
 
+    def exportEntry(self, entry):
+        self.queueExport(entry.image_id, entry.source, entry.target,
+                         entry.link_to)
+
+    def queueExport(self, imageId, mFilePath, tFilePath, linkTo=None):
+        """
+        Run exportFile for an image, on the pool if there is one. Returns
+        its pending result, if any.
+        """
+        if self.shard_targets is not None:
+            self.shard_targets.append(
+                os.path.relpath(tFilePath, self.dest_dir))
+        if self.checkpoint and self.checkpoint.isDone(tFilePath):
+            self.imageDone("-")
+            return None
+        args = (imageId, mFilePath, tFilePath, linkTo)
+        if self.pool:
+            # Directories and deconflicted names are settled by now, in the
+            # calling thread; only the stat/copy/metadata work is handed off.
+            result = self.pool.apply_async(self.exportFile, args)
+            self.pending.append((result, mFilePath, tFilePath))
+            self.flushCopies(self.jobs * 4)
+            return result
+        self.imageDone(self.exportFile(*args), mFilePath, tFilePath)
+        return None
+
+    def makeFolder(self, folderName):
+        if folderName in self.folders_made:
+            return
+        self.folders_made.add(folderName)
         if not os.path.exists(folderName):
             try:
                 if not self.test:
                     os.makedirs(folderName)
-            except OSError, why:
-                raise iPhotoLibraryError, \
-                    "Can't create %s: %s" % (folderName, why[1])
+            except OSError as why:
+                raise iPhotoLibraryError(
+                    "Can't create %s: %s" % (folderName, why.strerror))
             self.status("  Created %s\n" % folderName)
 
+    def targetPath(self, imageId, folderName):
+        """
+        Return the path of imageId's file in the library, and the
+        (deconflicted) path to export it to in folderName.
+        """
+        try:
+            image = self.images[imageId]
+        except KeyError:
+            raise iPhotoLibraryError("Can't find image #%s" % imageId)
+
+        mFilePath = self.sourcePath(image)
+        basename = os.path.basename(mFilePath)
+
+        # Deconflict ouput filenames
+        tFilePath = os.path.join(folderName, basename)
+        if self.deconflict:
+            if folderName not in self.output_files:
+                self.output_files[folderName] = NameIndex()
+            tFilePath = self.output_files[folderName].claim(
+                tFilePath,
+                lambda j: os.path.join(folderName, "%02d_"%j + basename)
+            )
+        return mFilePath, tFilePath
+
+    def sourcePath(self, image):
+        """
+        Return the path of image's file in the library: its original if
+        originals is True, otherwise its edited version.
+        """
         #Unedited images only have ImagePath, edited images have both ImagePath and OriginalPath,
         #except for some corrupted iPhoto libraries, where some images only have OriginalPath.
         #Trying to satisfy both conditions with this nested logic.
         if self.originals:
             if "OriginalPath" in image:
-                mFilePath = image["OriginalPath"]
+                return image["OriginalPath"]
             else:
-                mFilePath = image["ImagePath"]
+                return image["ImagePath"]
         else:
             if not "ImagePath" in image:
-                mFilePath = image["OriginalPath"]
+                return image["OriginalPath"]
             else:
-                mFilePath = image["ImagePath"]
-        basename = os.path.basename(mFilePath)
+                return image["ImagePath"]
 
-        # Deconflict ouput filenames
-        tFilePath = os.path.join(folderName, basename)
-        if self.deconflict:
-            j = 1
-            while tFilePath in self.output_files:
-                tFilePath = os.path.join(folderName, "%02d_"%j + basename)
-                j += 1
-            self.output_files.add(tFilePath)
+    def firstExport(self, mFilePath, tFilePath):
+        """
+        In link mode, only the first export of each master is a real copy;
+        later ones (the same image in other albums) link to it. Return
+        [first tFilePath, its pending result] if tFilePath should be a
+        link, or None if it should be a copy.
 
-        # Skip unchanged files, unless we're writing metadata.
-        if not self.use_metadata and os.path.exists(tFilePath):
-            mStat = os.stat(mFilePath)
-            tStat = os.stat(tFilePath)
+        A master that isn't there is never recorded, since its first export
+        won't be a copy that can be linked to.
+        """
+        if self.link_mode == "copy":
+            return None
+        first = self.exported.get(mFilePath)
+        if first is None:
+            if self.source_files.stat(mFilePath) is not None:
+                self.exported[mFilePath] = [tFilePath, None]
+            return None
+        if first[0] == tFilePath:
+            return None
+        return first
 
-            if not self.ignore_time_delta and abs(tStat[stat.ST_MTIME] - mStat[stat.ST_MTIME]) <= 10:
-                self.status("-")
-                return
+    def copyImage(self, imageId, folderName, folderDate):
+        """
+        Copy an image from the library to a folder in the dest_dir. The
+        name of the folder is based on folderName and folderDate; if
+        folderDate is None, it's only based upon the folderName.
 
-            if tStat[stat.ST_SIZE] == mStat[stat.ST_SIZE]:
-                self.status("-")
-                return
+        If use_metadata is True, also write the image metadata from the library
+        to the copy. If use_faces is True, faces will be saved as keywords.
+        """
+        start = time.time()
+        if imageId not in self.images:
+            raise iPhotoLibraryError("Can't find image #%s" % imageId)
+
+        self.makeFolder(folderName)
+        mFilePath, tFilePath = self.targetPath(imageId, folderName)
+
+        linkTo = None
+        first = self.firstExport(mFilePath, tFilePath)
+        if first:
+            linkTo = first[0]
+            if first[1] is not None:
+                first[1].wait()
+
+        if self.metrics:
+            self.metrics.add("plan", time.time() - start)
 
-        if not self.test and os.path.exists(mFilePath):
-            shutil.copy2(mFilePath, tFilePath)
+        result = self.queueExport(imageId, mFilePath, tFilePath, linkTo)
+        first = self.exported.get(mFilePath)
+        if linkTo is None and first and first[0] == tFilePath:
+            first[1] = result
+
+    def exportFile(self, imageId, mFilePath, tFilePath, linkTo=None):
+        """
+        Copy mFilePath to tFilePath (and write its metadata, if use_metadata
+        is True), returning the progress character for the image. If
+        linkTo is given, it is an earlier export of the same master, and
+        tFilePath is linked to it instead, or copied from mFilePath if that
+        can't be done.
+
+        This may run in a worker thread when jobs > 1, so it must not touch
+        output_dirs or output_files.
+        """
+        if linkTo:
+            if self.scheduler:
+                self.scheduler.start(0)
+            try:
+                linked = self.linkFile(linkTo, tFilePath)
+            finally:
+                if self.scheduler:
+                    self.scheduler.done(0)
+            if linked:
+                return linked
+
+        start = time.time()
+        unchanged, mStat = self.isUnchanged(mFilePath, tFilePath)
+        if self.metrics:
+            self.metrics.add("stat", time.time() - start, tFilePath)
+        if unchanged:
+            return "-"
+
+        if mStat is None and not self.test:
+            mStat = self.source_files.stat(mFilePath)
+        if not self.test and mStat:
+            if self.scheduler:
+                self.scheduler.start(mStat.st_size)
+            start = time.time()
+            try:
+                strategy = self.copier.copy(mFilePath, tFilePath)
+            finally:
+                if self.scheduler:
+                    self.scheduler.done(mStat.st_size)
+            # The copy has the master's size and times.
+            self.target_files.record(tFilePath, mStat)
+            if self.metrics:
+                self.metrics.add("copy", time.time() - start, tFilePath)
+                self.metrics.count("copied_by_" + strategy)
+                self.metrics.count("bytes_copied", mStat.st_size)
+            if self.manifest:
+                self.manifest.record(tFilePath, mFilePath, mStat)
         md_written = False
         if self.use_metadata:
+            start = time.time()
             md_written = self.writePhotoMD(imageId, tFilePath)
+            if self.metrics:
+                self.metrics.add("metadata", time.time() - start, tFilePath)
         if md_written:
-            self.status("+")
+            return "+"
         else:
-            self.status(".")
+            return "."
+
+    def isUnchanged(self, mFilePath, tFilePath):
+        """
+        Decide whether tFilePath is an unchanged copy of mFilePath and can
+        be skipped. Returns that and the stat of mFilePath, if it was
+        needed.
+        """
+        mStat = None
+        if self.manifest:
+            mStat = self.source_files.stat(mFilePath)
+
+        # Skip unchanged files, unless we're writing metadata.
+        if not self.use_metadata:
+            if mStat and self.manifest.unchanged(tFilePath, mFilePath, mStat):
+                return True, mStat
+
+            tStat = self.target_files.stat(tFilePath)
+            if tStat:
+                mStat = self.source_files.stat(mFilePath)
+                if mStat is None:
+                    return False, None
+
+                if (not self.ignore_time_delta and abs(tStat[stat.ST_MTIME] - mStat[stat.ST_MTIME]) <= 10) \
+                        or tStat[stat.ST_SIZE] == mStat[stat.ST_SIZE]:
+                    if self.manifest:
+                        self.manifest.record(tFilePath, mFilePath, mStat)
+                    return True, mStat
+        return False, mStat
+
+    def linkFile(self, linkTo, tFilePath):
+        """
+        Make tFilePath a hard link, symlink or reflink (depending on
+        link_mode) to linkTo, which already has the image's metadata.
+        Returns None if the link can't be made, so that exportFile copies
+        the master instead.
+        """
+        if os.path.lexists(tFilePath):
+            try:
+                if os.path.samefile(linkTo, tFilePath) or (
+                        self.link_mode == "reflink" and
+                        os.path.getsize(linkTo) == os.path.getsize(tFilePath)):
+                    return "-"
+            except OSError:
+                pass
+            if not self.test:
+                os.remove(tFilePath)
+        if self.test:
+            return "="
+        try:
+            if self.link_mode == "hardlink":
+                os.link(linkTo, tFilePath)
+            elif self.link_mode == "symlink":
+                os.symlink(
+                    os.path.relpath(linkTo, os.path.dirname(tFilePath)),
+                    tFilePath
+                )
+            else:
+                reflink(linkTo, tFilePath)
+        except (IOError, OSError):
+            return None
+        return "="
+
+    def close(self, finished=False):
+        """
+        Save anything that is kept across runs. Call this once the walk is
+        over, even if it was interrupted; finished says whether it wasn't.
+        """
+        if self.checkpoint:
+            self.checkpoint.close(finished)
+        if self.shard and finished and not self.test:
+            self.writeShardRecord()
+        if self.manifest:
+            self.manifest.close()
+        if self.metadata_writer:
+            self.metadata_writer.close()
+        if self.metrics:
+            if self.show_timings:
+                self.status("* Timings:\n" + self.metrics.summary())
+            self.metrics.close()
+
+    shard_record = ".exportiphoto-shard-%iof%i.json"
+
+    def writeShardRecord(self):
+        """
+        Note in dest_dir that this shard has finished, and what it
+        exported, for mergeShards.
+        """
+        path = os.path.join(self.dest_dir, self.shard_record % self.shard)
+        try:
+            f = open(path, 'w')
+            try:
+                json.dump({"shard": self.shard[0], "shards": self.shard[1],
+                           "targets": self.shard_targets}, f)
+            finally:
+                f.close()
+        except IOError as why:
+            raise iPhotoLibraryError(
+                "Can't write shard record %s: %s" % (path, why))
+
+    def mergeShards(self, shards):
+        """
+        Check that the shards of an export run with --shard i/shards have
+        all finished and between them exported every image once, to where
+        an unsharded export would have. If so, merge their manifests into
+        this one and remove their records; if not, raise
+        iPhotoLibraryError saying what is missing.
+        """
+        expected = set([os.path.relpath(e.target, self.dest_dir)
+                        for e in self.plan()])
+        problems = []
+        exported = {}
+        for i in range(1, shards + 1):
+            path = os.path.join(self.dest_dir, self.shard_record % (i, shards))
+            try:
+                f = open(path, 'r')
+                try:
+                    targets = json.load(f)["targets"]
+                finally:
+                    f.close()
+            except (IOError, ValueError, KeyError):
+                problems.append("Shard %i of %i hasn't finished." % (i, shards))
+                continue
+            for target in targets:
+                if target in exported:
+                    problems.append("%s was exported by shards %i and %i." %
+                                    (target, exported[target], i))
+                exported[target] = i
+        missing = [t for t in expected if t not in exported or
+                   not self.target_files.stat(os.path.join(self.dest_dir, t))]
+        extra = [t for t in exported if t not in expected]
+        for targets, what in ((missing, "missing"), (extra, "unexpected")):
+            if targets:
+                targets.sort()
+                problems.append("%i exported images are %s, e.g. %s" %
+                                (len(targets), what, targets[0]))
+        if problems:
+            raise iPhotoLibraryError("\n".join(problems))
+
+        for i in range(1, shards + 1):
+            if self.test:
+                break
+            if self.manifest:
+                self.manifest.merge("-%iof%i" % (i, shards))
+            os.remove(os.path.join(self.dest_dir,
+                                   self.shard_record % (i, shards)))
+        self.status("* All %i shards finished: %i images exported.\n" %
+                    (shards, len(expected)), force=True)
+
+    def queueDepth(self):
+        """
+        Return how many queued exports haven't finished yet.
+        """
+        return len([p for p in list(self.pending) if not p[0].ready()])
+
+    def flushCopies(self, limit=0):
+        """
+        Wait for queued copies until no more than limit are outstanding,
+        printing their progress in the order they were queued. Completed
+        copies at the head of the queue are always reported.
+        """
+        while self.pending and (len(self.pending) > limit or
+                                self.pending[0][0].ready()):
+            result, mFilePath, tFilePath = self.pending.popleft()
+            self.imageDone(result.get(), mFilePath, tFilePath)
+
+    def imageDone(self, result, mFilePath=None, tFilePath=None):
+        """
+        Report the progress character returned by exportFile, and record
+        that tFilePath is finished.
+        """
+        if self.checkpoint and tFilePath:
+            self.checkpoint.record(tFilePath, mFilePath)
+        self.status(result)
+        if self.metrics:
+            self.metrics.imageDone(result)
 
     def writePhotoMD(self, imageId, filePath=None):
         """
@@ -400,7 +2870,7 @@ end tell
         try:
             image = self.images[imageId]
         except KeyError:
-            raise iPhotoLibraryError, "Can't find image #%s" % imageId
+            raise iPhotoLibraryError("Can't find image #%s" % imageId)
 
         if not filePath:
             if self.originals:
@@ -418,40 +2888,47 @@ end tell
         caption = image.get("Caption", None)
         rating = image.get("Rating", None)
         comment = image.get("Comment", None)
-        keywords = set([self.keywords[k] for k in image.get("Keywords", [])])
-        if self.use_faces:
-            keywords.update([self.faces[f['face key']]
-                             for f in image.get("Faces", [])
-                             if self.faces.has_key(f['face key'])]
-            )
+        keywords = self.imageTags(image)
 
         if caption or comment or rating or keywords:
             try:
-                md = pyexiv2.ImageMetadata(filePath)
-                md.read()
-                if caption:
-                    md["Iptc.Application2.Headline"] = [caption]
-                if rating:
-                    md["Xmp.xmp.Rating"] = rating
-                if comment:
-                    md["Iptc.Application2.Caption"] = [comment]
-                if keywords:
-                    md["Iptc.Application2.Keywords"] = list(keywords)
-                if not self.test:
-                    md.write(preserve_timestamps=True)
+                self.metadata_writer.write(
+                    filePath, caption, rating, comment, keywords
+                )
                 return True
-            except IOError, why:
+            except IOError as why:
                 self.status("\nProblem setting metadata (%s) on %s\n" % (
-                    unicode(why.__str__(), errors='replace'), filePath
+                    toText(str(why)), filePath
                 ))
         return False
 
+    def imageTags(self, image):
+        """
+        Return the names of image's keywords (and, if use_faces is True,
+        faces), working them out only the first time the image is
+        exported. Images with the same keywords and faces share one set.
+        """
+        tags = image.tags
+        if tags is None:
+            if self.use_faces:
+                ids = (image.keywords, image.faces)
+            else:
+                ids = (image.keywords, None)
+            tags = self.tag_sets.get(ids)
+            if tags is None:
+                names = [tagName(self.keywords, k) for k in ids[0] or ()]
+                names.extend([tagName(self.faces, f) for f in ids[1] or ()])
+                tags = self.tag_sets[ids] = \
+                    frozenset([n for n in names if n is not None])
+            image.tags = tags
+        return tags
+
     def appleDate(self, text):
         try:
-            return datetime.utcfromtimestamp(self.apple_epoch + float(text))
+            return self.apple_epoch + timedelta(seconds=float(text))
         except (ValueError, TypeError):
-            raise iPhotoLibraryError, \
-            "Corrupted Library; unexpected value '%s' for date" % text
+            raise iPhotoLibraryError(
+                "Corrupted Library; unexpected value '%s' for date" % text)
 
     def status(self, msg, force=False):
         if force or not self.quiet:
@@ -471,45 +2948,72 @@ end tell
         When walking the xml eliminate any folder we find where one of the possible album names matches an
         existing album name.
         '''
+        delim = re.escape(str(self.date_delimiter))
+        self.named_import_re = re.compile(
+            r"(([0-9]{4})%s([0-9]{2})%s([0-9]{2})) ?(.*)" % (delim, delim))
+        self.dated_import_re = re.compile(
+            r"^[0-9]{4}%s[0-9]{2}%s[0-9]{2}$" % (delim, delim))
+
+        index = ImportIndex(self.dest_dir, str(self.date_delimiter))
         if self.year_dir:
             year_dir_list = os.listdir(self.dest_dir)
             for year_dir in year_dir_list:
                 # if year_dir was specified, then only match on folders inside year folders
-                if not re.match("^[0-9]{4}$", year_dir): continue
+                if not self.year_dir_re.match(year_dir): continue
 
                 # if import_from_date was specified, then skip folders where the year_dir is before the import_from_date.year
                 if self.import_from_date and int(year_dir) < self.import_from_date.year: continue
 
-                self.build_import_album_dirs(os.path.join(self.dest_dir, year_dir))
+                self.build_import_album_dirs(os.path.join(self.dest_dir, year_dir), index)
         else:
-            self.build_import_album_dirs(self.dest_dir)
+            self.build_import_album_dirs(self.dest_dir, index)
+        if not self.test:
+            index.save()
 
-    def build_import_album_dirs(self, base_dir):
-        delim = str(self.date_delimiter)
+    def scan_import_dir(self, base_dir):
+        """
+        List the dated folders in base_dir, as [folder name, [year, month,
+        day], [possible iPhoto album names]] lists.
+        """
+        folders = []
         for album_name in os.listdir(base_dir):
             album_names = [album_name]
-            folder_date = None
             # Folder pattern: "2011_01_01 New Years Party"
-            m = re.match(r"([0-9]{4}\%s[0-9]{2}\%s[0-9]{2}) ?(.*)" % (delim, delim), album_name)
-            if m:
-                folder_date = datetime.strptime(m.group(1), "%Y" + delim + "%m" + delim + "%d")
-                album_names.append(m.group(2))
+            m = self.named_import_re.match(album_name)
+            if not m: continue
+            try:
+                folder_date = datetime(*[int(g) for g in m.group(2, 3, 4)])
+            except ValueError:
+                continue # not a real date
+            album_names.append(m.group(5))
 
             # Folder pattern: "2011_01_01"
-            m = re.match(r"^[0-9]{4}\%s[0-9]{2}\%s[0-9]{2}$" % (delim, delim), album_name)
+            m = self.dated_import_re.match(album_name)
             if m:
-                folder_date = datetime.strptime(album_name, "%Y" + delim + "%m" + delim + "%d")
                 month, day, year = folder_date.strftime("%b %d %Y").split(" ")
                 album_names.append("%s %d, %s" %(month, int(day), year))
 
+            folders.append([album_name,
+                            [folder_date.year, folder_date.month,
+                             folder_date.day],
+                            [toText(n) for n in album_names]])
+        return folders
+
+    def build_import_album_dirs(self, base_dir, index):
+        for album_name, date, album_names in index.folders(
+                base_dir, self.scan_import_dir):
+            folder_date = datetime(*date)
+
             # Don't import folders that are prior to the specified date
-            if not folder_date: continue
             if self.import_from_date and folder_date < self.import_from_date: continue
 
             album_dir = os.path.abspath(os.path.join(base_dir, album_name))
 
             this_album = { "album_names": album_names, "album_dir":album_dir, }
             self.import_albums.append(this_album)
+            for name in set(album_names):
+                self.import_album_names.setdefault(
+                    toText(name), []).append(this_album)
 
 def error(msg):
     sys.stderr.write("\n%s\n" % msg)
@@ -517,6 +3021,12 @@ def error(msg):
 
 
 if __name__ == '__main__':
+    if sys.version_info[0] < 3:
+        # To allow Unicode characters to be displayed
+        # (see http://wiki.python.org/moin/PrintFails)
+        sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout)
+        sys.stderr = codecs.getwriter(locale.getpreferredencoding())(sys.stderr)
+
     usage   = "Usage: %prog [options] <iPhoto Library dir> <destination dir>"
     version = "exportiphoto version %s" % __version__
     default_date_delimiter = "-"
@@ -529,7 +3039,28 @@ if __name__ == '__main__':
         quiet=False,
         date=True,
         ignore_time_delta=False,
-        originals=False
+        originals=False,
+        jobs=1,
+        manifest=False,
+        parser="expat",
+        cache_file=None,
+        metadata_backend=None,
+        timings=False,
+        link_mode="copy",
+        metrics_file=None,
+        plan_file=None,
+        apply_plan=None,
+        resume=False,
+        copy_method="auto",
+        stream=False,
+        shard=None,
+        merge_shards=None,
+        verify=False,
+        checksums=False,
+        max_rate=None,
+        max_ops=None,
+        adaptive_jobs=False,
+        small_first=False
     )
 
     option_parser.add_option("-a", "--albums",
@@ -587,12 +3118,138 @@ if __name__ == '__main__':
                              help="only import missing folers if folder date occurs after (YYYY-MM-DD). Uses date in folder name."
     )
 
-    if pyexiv2:
+    option_parser.add_option("--jobs",
+                             action="store", type="int", dest="jobs",
+                             help="number of images to copy at the same time default=1"
+    )
+
+    option_parser.add_option("--manifest",
+                             action="store_true", dest="manifest",
+                             help="keep a manifest in the destination so re-runs only check changed images"
+    )
+
+    option_parser.add_option("--parser",
+                             action="store", type="choice", dest="parser",
+                             choices=["expat", "dom"],
+                             help="AlbumData.xml parser to use: expat (fast) or dom (the old one) default=expat"
+    )
+
+    option_parser.add_option("--cache",
+                             action="store", type="string", dest="cache_file",
+                             help="reuse the parsed library from this file when AlbumData.xml hasn't changed"
+    )
+
+    option_parser.add_option("--select",
+                             action="append", type="string", dest="select",
+                             help="only export events (or albums) whose name matches this pattern, e.g. \"*Party*\"; may be given more than once"
+    )
+
+    option_parser.add_option("--from_date",
+                             action="store", type="string", dest="from_date",
+                             help="only export events on or after this date (YYYY-MM-DD)"
+    )
+
+    option_parser.add_option("--to_date",
+                             action="store", type="string", dest="to_date",
+                             help="only export events on or before this date (YYYY-MM-DD)"
+    )
+
+    option_parser.add_option("--link",
+                             action="store", type="choice", dest="link_mode",
+                             choices=["copy", "hardlink", "symlink", "reflink"],
+                             help="copy (default), hardlink, symlink or reflink images that are exported more than once (e.g. in several albums) to their first copy"
+    )
+
+    option_parser.add_option("--plan",
+                             action="store", type="string", dest="plan_file",
+                             help="work out the whole export first and save the plan to this file, then apply it (with -t, only save it)"
+    )
+
+    option_parser.add_option("--apply_plan",
+                             action="store", type="string", dest="apply_plan",
+                             help="apply (or resume) an export saved with --plan"
+    )
+
+    option_parser.add_option("--resume",
+                             action="store_true", dest="resume",
+                             help="resume an interrupted export, skipping the images it finished"
+    )
+
+    option_parser.add_option("--copy_method",
+                             action="store", type="choice", dest="copy_method",
+                             choices=["auto", "kernel", "python"],
+                             help="auto (default) clones files on filesystems that support it and otherwise lets the kernel copy them where possible (on Linux); kernel never clones; python always copies through Python"
+    )
+
+    option_parser.add_option("--max_rate",
+                             action="store", type="float", dest="max_rate",
+                             help="copy no more than this many MB per second"
+    )
+
+    option_parser.add_option("--max_iops",
+                             action="store", type="float", dest="max_ops",
+                             help="copy (or link) no more than this many files per second"
+    )
+
+    option_parser.add_option("--adaptive_jobs",
+                             action="store_true", dest="adaptive_jobs",
+                             help="with --jobs, vary the number of copies made at the same time between 1 and --jobs, to whatever gets the most throughput"
+    )
+
+    option_parser.add_option("--small_first",
+                             action="store_true", dest="small_first",
+                             help="work out the whole export first, like --plan, and copy the smallest images first, so most of the library is done early"
+    )
+
+    option_parser.add_option("--stream",
+                             action="store_true", dest="stream",
+                             help="start exporting while the library is still being parsed, dropping images once they're exported"
+    )
+
+    option_parser.add_option("--shard",
+                             action="store", type="string", dest="shard",
+                             help="export only part i of N of the events (or albums), e.g. 2/4, so that several hosts can export the library into the same destination"
+    )
+
+    option_parser.add_option("--merge_shards",
+                             action="store", type="int", dest="merge_shards",
+                             help="check that all N parts of a --shard export finished and together exported every image, and merge their manifests"
+    )
+
+    option_parser.add_option("--verify",
+                             action="store_true", dest="verify",
+                             help="don't export; check that every image's copy is there and up to date, and list those that aren't"
+    )
+
+    option_parser.add_option("--checksums",
+                             action="store_true", dest="checksums",
+                             help="with --verify, also compare the checksums of copies and their sources (on --jobs threads), remembering them so unchanged files aren't read again"
+    )
+
+    option_parser.add_option("--timings",
+                             action="store_true", dest="timings",
+                             help="print how long each phase of the export took, and show throughput and ETA"
+    )
+
+    option_parser.add_option("--metrics",
+                             action="store", type="string", dest="metrics_file",
+                             help="append progress and timings to this file as JSON lines every 10 seconds"
+    )
+
+    if metadata_writers:
         option_parser.add_option("-m", "--metadata",
                                  action="store_true", dest="metadata",
                                  help="write metadata to images"
         )
 
+        option_parser.add_option("--metadata_backend",
+                                 action="store", type="choice",
+                                 dest="metadata_backend",
+                                 choices=sorted(metadata_writers.keys()),
+                                 help="write metadata with pyexiv2 or exiftool default=%s" %
+                                     default_metadata_backend
+        )
+
         option_parser.add_option("-f", "--faces",
                                  action="store_true", dest="faces",
                                  help="store faces as keywords (requires -m)"
@@ -605,6 +3262,51 @@ if __name__ == '__main__':
             "Please specify an iPhoto library and a destination."
         )
 
+    if options.jobs < 1:
+        option_parser.error("--jobs must be at least 1.")
+
+    if options.import_missing and (options.select or options.from_date or
+                                   options.to_date):
+        option_parser.error(
+            "-i can't be used with --select, --from_date or --to_date."
+        )
+
+    shard = None
+    if options.shard:
+        match = re.match(r"^(\d+)/(\d+)$", options.shard)
+        if match:
+            shard = (int(match.group(1)), int(match.group(2)))
+        if not shard or not 1 <= shard[0] <= shard[1]:
+            option_parser.error(
+                "--shard must be i/N, with i from 1 to N, e.g. 2/4."
+            )
+
+    if options.merge_shards is not None and options.merge_shards < 1:
+        option_parser.error("--merge_shards must be at least 1.")
+
+    if (shard or options.merge_shards) and options.import_missing:
+        option_parser.error(
+            "-i can't be used with --shard or --merge_shards."
+        )
+
+    if (options.max_rate is not None and options.max_rate <= 0) or \
+            (options.max_ops is not None and options.max_ops <= 0):
+        option_parser.error("--max_rate and --max_iops must be positive.")
+
+    if options.checksums and not options.verify:
+        option_parser.error("--checksums requires --verify.")
+
+    if shard and options.merge_shards:
+        option_parser.error("--shard can't be used with --merge_shards.")
+
+    if options.stream and (options.cache_file or options.plan_file or
+                           options.apply_plan or options.small_first or
+                           options.parser != "expat" or options.verify or
+                           options.merge_shards):
+        option_parser.error(
+            "--stream can't be used with --cache, --plan, --apply_plan, --small_first, --parser=dom, --verify or --merge_shards."
+        )
+
     try:
         if options.date_delimiter is None:
             options.date_delimiter = default_date_delimiter
@@ -620,20 +3322,64 @@ if __name__ == '__main__':
                                 year_dir=options.year_dir,
                                 import_missing=options.import_missing,
                                 import_from_date=options.import_from_date,
-                                test=options.test,
+                                test=options.test or options.verify,
                                 date_delimiter=options.date_delimiter,
                                 ignore_time_delta=options.ignore_time_delta,
-                                originals=options.originals
+                                originals=options.originals,
+                                jobs=options.jobs,
+                                use_manifest=options.manifest,
+                                parser=options.parser,
+                                cache_file=options.cache_file,
+                                select=options.select,
+                                from_date=options.from_date,
+                                to_date=options.to_date,
+                                metadata_backend=options.metadata_backend,
+                                timings=options.timings,
+                                link_mode=options.link_mode,
+                                metrics_file=options.metrics_file,
+                                resume=options.resume,
+                                copy_method=options.copy_method,
+                                stream=options.stream,
+                                shard=shard,
+                                max_rate=options.max_rate and
+                                    options.max_rate * 1048576,
+                                max_ops=options.max_ops,
+                                adaptive_jobs=options.adaptive_jobs
                                 )
         def copyImage(imageId, folderName, folderDate):
             library.copyImage(imageId, folderName, folderDate)
-    except iPhotoLibraryError, why:
-        error(why[0])
+    except iPhotoLibraryError as why:
+        error(why.args[0])
     except KeyboardInterrupt:
         error("Interrupted.")
+    finished = False
     try:
-        library.walk([copyImage])
-    except iPhotoLibraryError, why:
-        error(why[0])
+        if options.verify:
+            problems = library.verify(options.checksums)
+            for kind in sorted(problems):
+                for path in problems[kind]:
+                    library.status("%s: %s\n" % (kind, path), force=True)
+            finished = True
+            if [p for p in problems.values() if p]:
+                sys.exit(1)
+        elif options.merge_shards:
+            library.mergeShards(options.merge_shards)
+        elif options.apply_plan:
+            library.execute(library.readPlan(options.apply_plan),
+                            options.small_first)
+        elif options.plan_file:
+            plan = library.plan()
+            library.writePlan(plan, options.plan_file)
+            if not options.test:
+                library.execute(plan, options.small_first)
+        elif options.small_first:
+            library.execute(library.plan(), True)
+        else:
+            library.walk([copyImage])
+        finished = True
+    except iPhotoLibraryError as why:
+        error(why.args[0])
     except KeyboardInterrupt:
-        error("Interrupted. Copy may be incomplete.")
+        error("Interrupted. Copy may be incomplete; use --resume to continue.")
+    finally:
+        library.close(finished)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Tests for iPhotoLibrary.iterImages and its parsers, run against a small
+synthetic library from benchmark.py:
+
+    python -m unittest test_exportiphoto
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import benchmark
+import exportiphoto
+from exportiphoto import LibraryImage, iPhotoLibrary, iPhotoLibraryError
+
+
+class IterImagesTest(unittest.TestCase):
+    images = 120
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix="exportiphoto-test-")
+        cls.library_dir = os.path.join(cls.tmp_dir, "library")
+        cls.dest_dir = os.path.join(cls.tmp_dir, "export")
+        benchmark.generate_library(cls.library_dir, images=cls.images,
+                                   events=6, image_size=16)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def library(self, **kwargs):
+        return iPhotoLibrary(self.library_dir, self.dest_dir, use_date=True,
+                             deconflict=True, test=True, quiet=True, **kwargs)
+
+    def test_fields(self):
+        images = list(self.library().iterImages())
+        self.assertEqual(len(images), self.images)
+        self.assertEqual(len(set([i.image_id for i in images])), self.images)
+        for image in images:
+            self.assertTrue(isinstance(image, LibraryImage))
+            self.assertTrue(os.path.isfile(image.source_path))
+            self.assertTrue(image.source_path.startswith(self.library_dir))
+            self.assertEqual(os.path.dirname(image.target_dir),
+                             self.dest_dir)
+            self.assertTrue(isinstance(image.folder_date, datetime))
+            self.assertTrue(os.path.basename(image.target_dir).startswith(
+                image.folder_date.strftime("%Y-%m-%d")))
+            for tag in image.tags:
+                self.assertTrue(tag.startswith("Keyword "))
+        self.assertTrue([i for i in images if i.tags])
+
+    def test_albums(self):
+        images = list(self.library(use_album=True).iterImages())
+        self.assertTrue(images)
+        for image in images:
+            self.assertEqual(image.folder_date, None)
+
+    def test_stop_early(self):
+        library = self.library()
+        all_images = list(library.iterImages())
+        generator = library.iterImages()
+        first = list(itertools.islice(generator, 3))
+        generator.close()
+        self.assertEqual(first, all_images[:3])
+        self.assertEqual(list(library.iterImages()), all_images)
+
+    def test_repeat(self):
+        library = self.library()
+        first = list(library.iterImages())
+        self.assertEqual(list(library.iterImages()), first)
+
+    def test_walk_after(self):
+        library = self.library()
+        target_dirs = set([i.target_dir for i in library.iterImages()])
+        walked = set()
+        def visit(imageId, targetFileDir, folderDate):
+            walked.add(targetFileDir)
+        library.walk([visit])
+        self.assertEqual(walked, target_dirs)
+
+    def test_stream(self):
+        expected = list(self.library().iterImages())
+        library = self.library(stream=True)
+        self.assertEqual(list(library.iterImages()), expected)
+        self.assertEqual(library.images, {})
+        self.assertRaises(iPhotoLibraryError, list, library.iterImages())
+
+
+class NullWriter(object):
+    """
+    A metadata backend that writes nothing, so that faces are parsed
+    without pyexiv2 or exiftool.
+    """
+    name = "null"
+
+    def __init__(self, test=False):
+        pass
+
+    def write(self, filePath, caption, rating, comment, keywords):
+        pass
+
+    def close(self):
+        pass
+
+
+class ParserTest(unittest.TestCase):
+    """
+    The expat and dom parsers should read the same library.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix="exportiphoto-test-")
+        cls.library_dir = os.path.join(cls.tmp_dir, "library")
+        cls.nuls_dir = os.path.join(cls.tmp_dir, "nuls")
+        cls.dest_dir = os.path.join(cls.tmp_dir, "export")
+        benchmark.generate_library(cls.library_dir, images=60, events=4,
+                                   albums=3, faces=10, keywords=20,
+                                   image_size=16)
+        # iPhoto sometimes pads AlbumData.xml with NULs.
+        os.mkdir(cls.nuls_dir)
+        f = open(os.path.join(cls.library_dir, "AlbumData.xml"), 'rb')
+        data = f.read()
+        f.close()
+        f = open(os.path.join(cls.nuls_dir, "AlbumData.xml"), 'wb')
+        f.write(data.replace(b"</dict>", b"</dict>\0\0") + b"\0" * 5000)
+        f.close()
+        exportiphoto.metadata_writers[NullWriter.name] = NullWriter
+
+    @classmethod
+    def tearDownClass(cls):
+        del exportiphoto.metadata_writers[NullWriter.name]
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def parsed(self, library_dir, parser, **kwargs):
+        library = iPhotoLibrary(library_dir, self.dest_dir, test=True,
+                                quiet=True, parser=parser, **kwargs)
+        images = dict([(k, v.__getstate__())
+                       for k, v in library.images.items()])
+        return library.albums, images, library.keywords, library.faces
+
+    def check(self, library_dir, **kwargs):
+        expat = self.parsed(library_dir, "expat", **kwargs)
+        self.assertEqual(self.parsed(library_dir, "dom", **kwargs), expat)
+        return expat
+
+    def test_events(self):
+        albums, images, keywords, faces = self.check(self.library_dir)
+        self.assertEqual(len(images), 60)
+        self.assertEqual(len(albums), 4)
+        self.assertTrue([k for k in keywords if k])
+        self.assertEqual(faces, [])
+
+    def test_albums(self):
+        albums, images, keywords, faces = self.check(self.library_dir,
+                                                     use_album=True)
+        self.assertTrue([a for a in albums if a.get("KeyList")])
+
+    def test_faces(self):
+        albums, images, keywords, faces = self.check(
+            self.library_dir, use_faces=True, use_metadata=True,
+            metadata_backend=NullWriter.name)
+        self.assertTrue([f for f in faces if f])
+        self.assertTrue([i for i in images.values() if i[-1]])
+
+    def test_nuls(self):
+        for kwargs in ({}, {"use_album": True},
+                       {"use_faces": True, "use_metadata": True,
+                        "metadata_backend": NullWriter.name}):
+            self.assertEqual(self.check(self.nuls_dir, **kwargs),
+                             self.parsed(self.library_dir, "expat", **kwargs))
+
+
+if __name__ == "__main__":
+    unittest.main()